@@ -0,0 +1,67 @@
+"""
+Wall-clock time to read a large stream file, serially and with the
+decoding spread over a process pool.
+
+    python bench/load_parallel.py [numItems]
+"""
+
+import os, sys, time, tempfile, concurrent.futures
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from qtbridge import Document, Item, stream, parallel
+
+
+NUM_PROPS = 18
+
+
+class BenchItem(Item):
+
+    Item.registerProperties([
+        { 'attr': 'prop%i' % i, 'type': int, 'default': 0 } for i in range(NUM_PROPS)
+    ])
+
+
+def writeFile(numItems, path):
+    document = Document()
+    items = []
+    for i in range(numItems):
+        item = BenchItem()
+        for iProp in range(0, NUM_PROPS, 2):
+            item.prop('prop%i' % iProp).set(i, notify=False)
+        items.append(item)
+    document.addItems(*items)
+    document.saveFull(path)
+
+
+def timeSerial(path):
+    start = time.time()
+    with stream.openFile(path) as f:
+        stream.readDocument(Document(), f)
+    return time.time() - start
+
+
+def timeParallel(path, workers):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        executor.submit(int).result() # don't count worker startup
+        start = time.time()
+        parallel.readDocumentParallel(Document(), path, executor=executor)
+        return time.time() - start
+
+
+def main():
+    numItems = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    path = os.path.join(tempfile.mkdtemp(), 'bench.qtbs')
+    writeFile(numItems, path)
+    print('%i items, %i cores' % (numItems, os.cpu_count()))
+    serial = timeSerial(path)
+    print('  serial:      %6.2fs' % serial)
+    workers = 1
+    while workers <= max(os.cpu_count(), 1):
+        elapsed = timeParallel(path, workers)
+        print('  %2i workers:  %6.2fs  (%.2fx)' % (workers, elapsed, serial / elapsed))
+        workers *= 2
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Report the memory cost per Item for a large synthetic Document.
+
+    python bench/memory_report.py [numItems]
+"""
+
+import os, sys, gc, tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from qtbridge import Document, Item
+
+
+NUM_PROPS = 18 # plus `tags` and `createdAt` from Item
+
+
+class BenchItem(Item):
+
+    Item.registerProperties([
+        { 'attr': 'prop%i' % i, 'type': int, 'default': 0 } for i in range(NUM_PROPS)
+    ])
+
+
+def measure(numItems, touch):
+    """ Return bytes/item. `touch` = number of props set on each item. """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    document = Document()
+    items = []
+    for i in range(numItems):
+        item = BenchItem()
+        for iProp in range(touch):
+            item.prop('prop%i' % iProp).set(i, notify=False)
+        items.append(item)
+    document.addItems(*items)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / numItems
+
+
+def main():
+    numItems = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    print('%i items, %i properties per item' % (numItems, NUM_PROPS + 2))
+    for touch in (0, 5, NUM_PROPS):
+        print('  %2i props set: %8.1f bytes/item' % (touch, measure(numItems, touch)))
+
+
+if __name__ == '__main__':
+    main()
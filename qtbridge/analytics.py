@@ -0,0 +1,106 @@
+""" Analytics events queued off the undo path and sent in batches from a
+background thread.
+
+    commands.stack().setAnalyticsSink(analytics.FileSink('/tmp/events.jsonl'))
+"""
+
+import time, json, threading
+
+
+class NullSink:
+    """ Default sink. """
+
+    def send(self, events):
+        ### Send to some analytics API here.
+        pass
+
+
+class FileSink:
+    """ Append events as JSON lines, e.g. for tests. """
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, events):
+        with open(self.path, 'a') as f:
+            for event in events:
+                f.write(json.dumps(event, default=str) + '\n')
+
+
+class AnalyticsQueue:
+    """ enqueue() only appends to a list under a lock. A daemon thread sends
+    batches of up to `batchSize` to `sink` every `interval` seconds, or
+    sooner once a batch is full. Past `maxQueued`, events are counted
+    per name instead of queued and sent as one event with a 'dropped' count.
+    """
+
+    def __init__(self, sink=None, maxQueued=1000, batchSize=100, interval=2.0):
+        self.sink = sink or NullSink()
+        self.maxQueued = maxQueued
+        self.batchSize = batchSize
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._events = []
+        self._dropped = {}
+        self._thread = None
+        self._stopping = False
+        self.sent = 0
+        self.failures = 0
+
+    def enqueue(self, eventName, properties={}):
+        with self._lock:
+            if len(self._events) >= self.maxQueued:
+                self._dropped[eventName] = self._dropped.get(eventName, 0) + 1
+            else:
+                self._events.append({
+                    'event': eventName,
+                    'properties': dict(properties),
+                    'time': time.time()
+                })
+            full = len(self._events) >= self.batchSize
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='analytics', daemon=True)
+                self._thread.start()
+        if full:
+            self._wake.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._events) + len(self._dropped)
+
+    def flush(self):
+        """ Send everything queued so far; safe from any thread. """
+        with self._lock:
+            events, self._events = self._events, []
+            dropped, self._dropped = self._dropped, {}
+        for eventName, count in dropped.items():
+            events.append({
+                'event': eventName,
+                'properties': { 'dropped': count },
+                'time': time.time()
+            })
+        for i in range(0, len(events), self.batchSize):
+            batch = events[i:i + self.batchSize]
+            try:
+                self.sink.send(batch)
+                self.sent += len(batch)
+            except Exception:
+                self.failures += 1
+
+    def stop(self):
+        """ Send what is left and end the worker thread. """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._stopping = thread is not None
+        if thread is not None:
+            self._wake.set()
+            thread.join()
+        self._stopping = False
+        self.flush()
+
+    def _run(self):
+        while not self._stopping:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            self.flush()
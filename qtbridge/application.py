@@ -8,6 +8,8 @@ from .qmlengine import QmlEngine
 class Application(QApplication, Debug):
     """ Python prefs, exception logging, abort() prevention, etc. """
 
+    prefsChanged = pyqtSignal(str) # key, from setPref()
+
     @classmethod
     def prefs():
         return Application.instance()._prefs
@@ -102,6 +104,8 @@ class Application(QApplication, Debug):
 
         self._qmlEngine = QmlEngine(self) # this is always a singleton anyway, so add it here.
         self.osOpenedFile = None
+        from . import commands
+        self.prefsChanged.connect(commands.stack().onPrefsChanged)
 
     def deinit(self):
         def iCloudDevPostInit():
@@ -114,6 +118,9 @@ class Application(QApplication, Debug):
         CUtil.instance().deinit()
         CUtil.shutdown()
 
+        from . import commands
+        commands.stack().analytics().stop() # sends what is still queued
+
         sys.excepthook = self._excepthook_was
         self._excepthook_was = None
 
@@ -124,9 +131,37 @@ class Application(QApplication, Debug):
     # def onPaletteChanged(self):
     #     self.here(CUtil.isAppleDarkMode())
 
+    def setPref(self, key, value):
+        """ prefs().setValue() that also emits prefsChanged. """
+        self.prefs().setValue(key, value)
+        self.prefsChanged.emit(key)
+
     def qmlEngine(self):
         return self._qmlEngine
 
+    def journalPath(self):
+        return os.path.join(util.appDataDir(), util.APP_NAME, 'journal.qtbj')
+
+    def startJournal(self, document, path=None):
+        """ Replay edits left unsaved by a crash into `document`, freshly
+        loaded from its last save, then journal new edits to the same file.
+        A journal left by some other document or save is discarded instead.
+        Returns the number of changes recovered.
+        """
+        from . import commands, journal
+        if path is None:
+            path = self.journalPath()
+        recovered = 0
+        if os.path.isfile(path):
+            recovered = journal.replayJournal(document, path)
+            if recovered:
+                commands.trackApp('Recovered unsaved changes')
+        commandJournal = journal.CommandJournal(path)
+        if not recovered: # keep recovered edits until the next save
+            commandJournal.clear(document.savePoint())
+        commands.stack().setJournal(commandJournal)
+        return recovered
+
     def event(self, e):
         """ Port to C++ for speed? There aren't many events coming through here actually..."""
         if e.type() == QEvent.FileOpen:
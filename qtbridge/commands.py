@@ -3,20 +3,69 @@
 ##
 ##
 
-from .pyqt import QUndoStack, QUndoCommand
+import time, pickle
+from .pyqt import QUndoStack, QUndoCommand, pyqtSignal, pyqtSlot
 from . import util
 from . import Application
+from .analytics import AnalyticsQueue
+from .undospill import estimateSize, SpillFile
+from .commandstats import CommandStats
 
 
 class UndoStack(QUndoStack, util.Debug):
-    """ QUndoStack that tracks commands for analytics. """
+    """ QUndoStack that tracks commands for analytics.
 
-    def __init__(self, *args, **kwargs):
+    Once the estimated size of the commands passes `maxBytes`, the payloads
+    of the oldest commands are moved to a temp file and loaded back when
+    they are undone or redone.
+    """
+
+    MAX_BYTES = 64 * 1024 * 1024
+
+    # class name, 'push'|'merge'|'undo'|'redo', microseconds; see setInstrumented()
+    commandTimed = pyqtSignal(str, str, float)
+
+    def __init__(self, *args, maxBytes=MAX_BYTES, **kwargs):
         super().__init__(*args, **kwargs)
         self.lastId = None
+        self._macroText = None
+        self._macroLevel = 0
+        self._macroOpen = False
+        self._maxBytes = maxBytes
+        self._bytes = 0 # running estimate, recounted by memoryUsage()
+        self._pushesSinceCount = 0
+        self._spillIndex = 0 # commands below this were already offered to spill()
+        self._spillFile = SpillFile()
+        self._analytics = AnalyticsQueue()
+        self._analyticsEnabled = None # cached pref, see refreshAnalyticsPrefs()
+        self._journal = None
+        self._stats = None
+        self._pushing = False
+        self._driving = False # inside undo(), redo() or setIndex() below
+        self._coalescing = False # see _beginStep()
+        self.indexChanged.connect(self._onIndexChanged)
+
+    def openMacro(self, text):
+        """ Like beginMacro() but the macro is only created if a command is
+        pushed before closeMacro(), so empty edits leave no undo entry. Nests.
+        """
+        self._macroLevel += 1
+        if self._macroLevel == 1:
+            self._macroText = text
+            self._macroOpen = False
+
+    def closeMacro(self):
+        self._macroLevel -= 1
+        assert self._macroLevel >= 0
+        if self._macroLevel == 0 and self._macroOpen:
+            self._macroOpen = False
+            self.endMacro()
 
     def push(self, cmd):
         """ Track analytics for non-compressed commands. """
+        if self._macroLevel and not self._macroOpen:
+            self._macroOpen = True
+            self.beginMacro(self._macroText)
         s = None
         if isinstance(cmd.ANALYTICS, str):
             s = 'Commands: ' + cmd.ANALYTICS
@@ -24,17 +73,206 @@ class UndoStack(QUndoStack, util.Debug):
             s = 'Commands: ' + cmd.text()
         if s:
             self.track(s, cmd.analyticsProperties())
-        super().push(cmd)
+        stats = self._stats
+        if stats is not None:
+            merging = cmd.id() != -1 and cmd.id() == self.lastId
+            start = time.perf_counter()
+        cmd._stack = self
+        self._pushing = True # the first redo() is recorded here, not as a step
+        try:
+            super().push(cmd)
+        finally:
+            self._pushing = False
+        if stats is not None:
+            self._recordTime(cmd, 'merge' if merging else 'push', start)
         self.lastId = cmd.id()
+        if self._journal is not None:
+            self._journal.write(cmd.journal())
+        size = cmd.sizeEstimate()
+        self._bytes += size
+        if stats is not None:
+            stats.record(cmd.__class__.__name__, 'bytes', size)
+        # Merges, undone commands, and rehydrated payloads make the running
+        # estimate drift; recount once per stack length of pushes.
+        self._pushesSinceCount += 1
+        if self._pushesSinceCount > self.count():
+            self.memoryUsage()
+        if (self._maxBytes and self._bytes > self._maxBytes and
+            self._spillIndex < self.index() - 1): # something new to offer
+            self.spill()
+
+    ## Undo and redo steps
+    #
+    # QUndoStack.undo(), redo() and setIndex() are non-virtual, so QUndoView
+    # and QUndoGroup call the C++ ones directly. Each UndoCommand's undo()
+    # and redo() call _beginStep() and _endCommand() instead. When the
+    # overrides below drive the stack, e.g. from Python or the undo and redo
+    # actions, the step spans the whole macro or setIndex() range. Otherwise
+    # each top-level command ends its own step.
+
+    def _drive(self, method, *args):
+        was = self._driving
+        self._driving = True
+        try:
+            method(*args)
+        finally:
+            self._driving = was
+            if not was:
+                self._endStep()
+
+    @pyqtSlot()
+    def undo(self):
+        self._drive(super().undo)
+
+    @pyqtSlot()
+    def redo(self):
+        self._drive(super().redo)
+
+    @pyqtSlot(int)
+    def setIndex(self, index):
+        self._drive(super().setIndex, index)
+
+    def _beginStep(self):
+        """ Notifications are coalesced per (item, attr) over the whole
+        step, see property.coalescedNotifications(). """
+        if not self._coalescing:
+            from .property import beginCoalescing
+            self._coalescing = beginCoalescing()
+
+    def _endStep(self):
+        if self._coalescing:
+            from .property import endCoalescing
+            self._coalescing = False
+            endCoalescing()
+
+    def _endCommand(self, cmd, measure, start):
+        if self._stats is not None:
+            self._recordTime(cmd, measure, start)
+        if self._journal is not None:
+            self._journal.write(cmd.journal(undo=measure == 'undo'))
+
+    def clear(self):
+        super().clear()
+        self._bytes = 0
+        self._pushesSinceCount = 0
+        self._spillIndex = 0
+        self._spillFile.clear()
+
+    def _onIndexChanged(self, index):
+        if index < self._spillIndex: # undone commands were rehydrated
+            self._spillIndex = index
+
+    def journal(self):
+        return self._journal
+
+    def setInstrumented(self, on):
+        """ Record per-command-class timings and sizes into stats(). """
+        if on and self._stats is None:
+            self._stats = CommandStats()
+        elif not on:
+            self._stats = None
+
+    def stats(self):
+        """ The CommandStats while instrumented, otherwise None. """
+        return self._stats
+
+    def _recordTime(self, cmd, measure, start):
+        micros = (time.perf_counter() - start) * 1000000
+        className = cmd.__class__.__name__ if isinstance(cmd, UndoCommand) else 'Macro'
+        self._stats.record(className, measure, micros)
+        self.commandTimed.emit(className, measure, micros)
+
+    def setJournal(self, journal):
+        """ Write every push, undo, and redo to a journal.CommandJournal. """
+        self._journal = journal
+
+    def setMaxBytes(self, maxBytes):
+        """ None for no limit. """
+        self._maxBytes = maxBytes
+        if maxBytes and self.memoryUsage() > maxBytes:
+            self.spill()
+
+    def _commands(self, end=None, start=0):
+        """ Every UndoCommand from `start` to below `end`, including those
+        in macros. """
+        todo = [self.command(i) for i in range(start, self.count() if end is None else end)]
+        todo.reverse()
+        while todo:
+            cmd = todo.pop()
+            if isinstance(cmd, UndoCommand):
+                yield cmd
+            todo.extend(cmd.child(i) for i in reversed(range(cmd.childCount())))
+
+    def memoryUsage(self):
+        """ Estimated bytes held in memory by all commands. """
+        self._bytes = sum(cmd.sizeEstimate() for cmd in self._commands())
+        self._pushesSinceCount = 0
+        return self._bytes
+
+    def memoryStats(self):
+        memory = self.memoryUsage()
+        spilled = sum(1 for cmd in self._commands() if cmd.isSpilled())
+        return {
+            'bytes': memory,
+            'maxBytes': self._maxBytes,
+            'spilledCommands': spilled,
+            'spillFileBytes': self._spillFile.size()
+        }
+
+    def spill(self):
+        """ Spill the oldest commands until 3/4 of `maxBytes` is left. The
+        command at the top can still be merged into, so it is never spilled.
+        Commands already offered are skipped, so pushing while nothing more
+        can be spilled doesn't walk the whole stack each time.
+        """
+        target = self._maxBytes * 3 // 4
+        memory = self._bytes
+        end = max(self.index() - 1, 0)
+        i = min(self._spillIndex, end)
+        while i < end and memory > target:
+            for cmd in self._commands(end=i + 1, start=i):
+                size = cmd.sizeEstimate()
+                if cmd.spill(self._spillFile):
+                    memory -= size - cmd.sizeEstimate()
+            i += 1
+        self._spillIndex = i
+        self._bytes = memory
 
     def track(self, eventName, properties={}):
-        if not Application.prefs() or util.IS_DEV or util.IS_IOS:
-            return
-        self.here(eventName)
-        enableAppUsageAnalytics = Application.prefs().value('enableAppUsageAnalytics', defaultValue=True, type=bool)
-        if enableAppUsageAnalytics:
-            ### Send to some analytics API here.
-            pass
+        """ Queue an event for the analytics thread; never blocks on I/O. """
+        enabled = self._analyticsEnabled
+        if enabled is None:
+            enabled = self.refreshAnalyticsPrefs()
+        if enabled:
+            self._analytics.enqueue(eventName, properties)
+
+    def refreshAnalyticsPrefs(self):
+        """ Re-read 'enableAppUsageAnalytics'. Called on first use and from
+        Application.prefsChanged. """
+        if util.IS_DEV or util.IS_IOS:
+            self._analyticsEnabled = False
+        elif not Application.prefs():
+            return False # no app yet, check again next time
+        else:
+            self._analyticsEnabled = Application.prefs().value('enableAppUsageAnalytics', defaultValue=True, type=bool)
+        return self._analyticsEnabled
+
+    def setAnalyticsEnabled(self, on):
+        if Application.prefs():
+            Application.instance().setPref('enableAppUsageAnalytics', on)
+        else:
+            self._analyticsEnabled = on
+
+    def onPrefsChanged(self, key):
+        if key == 'enableAppUsageAnalytics':
+            self.refreshAnalyticsPrefs()
+
+    def analytics(self):
+        return self._analytics
+
+    def setAnalyticsSink(self, sink):
+        self._analytics.flush()
+        self._analytics.sink = sink
 
 def track(eventName, properties={}):
     return stack().track(eventName, properties)
@@ -64,10 +302,44 @@ def nextId():
     return lastId
 
 
+def _undoStep(method, measure):
+    """ Wrap an UndoCommand subclass' undo() or redo() so its stack can
+    coalesce, time, and journal it no matter what drove the stack. """
+    def step(self):
+        stack = self._stack
+        if stack is None or stack._pushing or UndoCommand._inStep:
+            return method(self) # i.e. super().undo() from a subclass
+        UndoCommand._inStep = True
+        try:
+            stack._beginStep()
+            start = time.perf_counter()
+            method(self)
+        except Exception:
+            stack._endStep()
+            raise
+        finally:
+            UndoCommand._inStep = False
+        stack._endCommand(self, measure, start)
+        if not stack._driving: # e.g. a direct cmd.undo(), or QUndoView
+            stack._endStep()
+    step.__name__ = method.__name__
+    step.__doc__ = method.__doc__
+    return step
+
+
 class UndoCommand(QUndoCommand, util.Debug):
 
     ANALYTICS = True
 
+    _stack = None # set by UndoStack.push()
+    _inStep = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in ('undo', 'redo'):
+            if name in cls.__dict__:
+                setattr(cls, name, _undoStep(cls.__dict__[name], name))
+
     def __init__(self, text, id=-1):
         super().__init__(text)
         self._id = id
@@ -78,6 +350,57 @@ class UndoCommand(QUndoCommand, util.Debug):
     def analyticsProperties(self):
         return {}
 
+    ## Spilling to disk, see UndoStack.spill()
+
+    _spillFile = None
+    _spillOffset = None
+
+    def sizeEstimate(self):
+        return estimateSize(self.__dict__)
+
+    def isSpilled(self):
+        return self._spillOffset is not None
+
+    def spillState(self):
+        """ Virtual; detach and return the picklable bulk of this command, or
+        None if it can't be spilled. """
+        return None
+
+    def restoreState(self, state):
+        """ Virtual; re-attach what spillState() returned. """
+
+    def journal(self, undo=False):
+        """ Virtual; the changes made by redo(), or by undo() if `undo`,
+        in the id-based form described in journal.py. """
+        return []
+
+    def spill(self, spillFile):
+        if self._spillOffset is not None:
+            return False
+        state = self.spillState()
+        if state is None:
+            return False
+        try:
+            self._spillOffset = spillFile.write(state)
+        except (pickle.PicklingError, TypeError, AttributeError):
+            self.restoreState(state)
+            return False
+        self._spillFile = spillFile
+        return True
+
+    def rehydrate(self):
+        """ Load spilled state back; call before using it. """
+        if self._spillOffset is not None:
+            self.restoreState(self._spillFile.read(self._spillOffset))
+            self._spillOffset = None
+            self._spillFile = None
+
+
+def _itemChunk(item):
+    chunk = { 'kind': item.__class__.__name__ }
+    item.write(chunk)
+    return chunk
+
 
 class AddItem(UndoCommand):
     """ Add an item to the document.
@@ -96,6 +419,11 @@ class AddItem(UndoCommand):
     def undo(self):
         self.document.removeItem(self.item)
 
+    def journal(self, undo=False):
+        if undo:
+            return [('remove', self.item.id)]
+        return [('add', _itemChunk(self.item))]
+
 def addItem(*args):
     cmd = AddItem(*args)
     stack().push(cmd)
@@ -122,51 +450,52 @@ class RemoveItems(UndoCommand):
             'layerProperties': {}
         }
 
-        def mapItem(item):
-            for layer in document.layers():
-                layerEntries = {}
-                for prop in item.props:
-                    if prop.layered:
-                        value, ok = layer.getItemProperty(item.id, prop.name())
-                        if ok:
-                            if not item.id in layerEntries:
-                                layerEntries[item.id] = {}
-                            layerEntries[item.id][prop.name()] = {
-                                'prop': prop,
-                                'was': value
-                            }
-                if layerEntries:
-                    if not layer in self._unmapped['layerProperties']:
-                        self._unmapped['layerProperties'][layer] = {}
-                    self._unmapped['layerProperties'][layer].update(layerEntries)
-
         # Map anything that will be directly removed or removed as a dependency.
-        # Do the mappings first before the data structure is altered
+        # Do the mappings first before the data structure is altered.
+        # Only look up the overrides that exist rather than every layered
+        # prop of every item on every layer.
+        byId = { item.id: item for item in self.items }
+        itemIds = set(byId)
+        for layer in document.layers():
+            layerEntries = {}
+            for itemId, values in layer.overrides().valuesFor(itemIds).items():
+                item = byId[itemId]
+                for propName, was in values.items():
+                    prop = item.prop(propName)
+                    if prop is not None and prop.layered:
+                        if not itemId in layerEntries:
+                            layerEntries[itemId] = {}
+                        layerEntries[itemId][propName] = {
+                            'prop': prop,
+                            'was': was
+                        }
+            if layerEntries:
+                self._unmapped['layerProperties'][layer] = layerEntries
+
         for item in self.items:
             if item.isLayer:
                 self._unmapped['layers'].append({
                     'layer': item,
                 })
-            
-            mapItem(item)
-
 
     def redo(self):
         self.document.setBatchAddingRemovingItems(True)
-        for item in self.items:
-                
-            if item.isLayer:
-                for layerItem in self.document.layerItems():
-                    if item.id in layerItem.layers():
-                        layerItem.layers().remove(item.id)
-                    if not layerItem.layers(): # orphaned now
-                        self.document.removeItem(layerItem)
-                self.document.removeItem(item)
+        layers = [entry['layer'] for entry in self._unmapped['layers']]
+        if layers:
+            layerIds = set(layer.id for layer in layers)
+            orphaned = []
+            for layerItem in self.document.layerItems(): # one pass for all layers
+                itemLayers = layerItem.layers()
+                for layerId in layerIds.intersection(itemLayers):
+                    itemLayers.remove(layerId)
+                if not itemLayers: # orphaned now
+                    orphaned.append(layerItem)
+            self.document.removeItems(*(orphaned + layers))
 
         for layer, itemEntries in self._unmapped['layerProperties'].items():
-            for itemId, propEntries in itemEntries.items():
-                for propName, entry in propEntries.items():
-                    layer.resetItemProperty(entry['prop'])
+            layer.resetItemPropertiesMany([(itemId, propName)
+                                           for itemId, propEntries in itemEntries.items()
+                                           for propName in propEntries])
 
         self.document.setBatchAddingRemovingItems(False)
 
@@ -174,14 +503,32 @@ class RemoveItems(UndoCommand):
         self.document.setBatchAddingRemovingItems(True)
         #
         for layer, itemEntries in self._unmapped['layerProperties'].items():
-            for itemId, propEntries in itemEntries.items():
-                for propName, entry in propEntries.items():
-                    layer.setItemProperty(itemId, entry['prop'].name(), entry['was'])
+            layer.setItemPropertiesMany([(itemId, propName, entry['was'])
+                                         for itemId, propEntries in itemEntries.items()
+                                         for propName, entry in propEntries.items()])
         #
         for entry in self._unmapped['layers']: # before layer items
             self.document.addItem(entry['layer'])
         self.document.setBatchAddingRemovingItems(False)
 
+    def journal(self, undo=False):
+        ret = []
+        if undo:
+            for layer, itemEntries in self._unmapped['layerProperties'].items():
+                for itemId, propEntries in itemEntries.items():
+                    for propName, entry in propEntries.items():
+                        ret.append(('set', layer.id, itemId, propName, entry['was']))
+            for entry in self._unmapped['layers']:
+                ret.append(('add', _itemChunk(entry['layer'])))
+        else:
+            for entry in self._unmapped['layers']:
+                ret.append(('remove', entry['layer'].id))
+            for layer, itemEntries in self._unmapped['layerProperties'].items():
+                for itemId, propEntries in itemEntries.items():
+                    for propName in propEntries:
+                        ret.append(('reset', layer.id, itemId, propName))
+        return ret
+
 
 def removeItems(*args):
     stack().push(RemoveItems(*args))
@@ -189,7 +536,11 @@ def removeItems(*args):
 
 
 class SetItemProperty(UndoCommand):
-    """ Only ever called from Property.set(undo=bool|int). """
+    """ Only ever called from Property.set(undo=bool|int).
+
+    `data` is flat, { (layer, itemId, attr): entry }, so merging is
+    proportional to the number of props in the newer command.
+    """
     
     ANALYTICS = 'SetItemProperty'
     
@@ -199,104 +550,176 @@ class SetItemProperty(UndoCommand):
         else:
             super().__init__('Set %s' % prop.name(), id)
         self.data = {}
-        def _addEntry(layer, prop, value, was):
-            if not layer in self.data:
-                self.data[layer] = {}
-            if not prop.item.id in self.data[layer]:
-                self.data[layer][prop.item.id] = {}
-            self.data[layer][prop.item.id][prop.name()] = {
-                'value': value,
-                'prop': prop
-            }
-            self.data[layer][prop.item.id][prop.name()]['wasSet'] = prop.isset()
-            if not was is None:
-                self.data[layer][prop.item.id][prop.name()]['was'] = was
+        self._addProp(prop, value, layers)
+        self.firstTime = True # yep
+
+    def _addProp(self, prop, value, layers):
+        wasSet = prop.isset()
         if layers:
             for layer in layers:
                 was, ok = layer.getItemProperty(prop.item.id, prop.name())
-                _addEntry(layer, prop, value, was)
+                self._addEntry(layer, prop, value, was, wasSet)
         else:
-            _addEntry(None, prop, value, prop.get())
-        self.firstTime = True # yep
+            self._addEntry(None, prop, value, prop.get(), wasSet)
+
+    def _addEntry(self, layer, prop, value, was, wasSet):
+        entry = {
+            'value': value,
+            'prop': prop,
+            'wasSet': wasSet
+        }
+        if not was is None:
+            entry['was'] = was
+        self.data[(layer, prop.item.id, prop.name())] = entry
+
+    def spillState(self):
+        self._refs = [(layer, data['prop'].item) for (layer, itemId, propName), data in self.data.items()]
+        state = [(propName, { k: v for k, v in data.items() if k != 'prop' })
+                 for (layer, itemId, propName), data in self.data.items()]
+        self.data = None
+        return state
+
+    def restoreState(self, state):
+        self.data = {}
+        for (layer, item), (propName, data) in zip(self._refs, state):
+            data['prop'] = item.prop(propName)
+            self.data[(layer, item.id, propName)] = data
+        self._refs = None
 
     def redo(self):
         if self.firstTime:
             self.firstTime = False
             return
-        for layer, itemData in self.data.items():
-            for itemId, props in itemData.items():
-                for propName, data in props.items():
-                    if layer:
-                        layer.setItemProperty(itemId, propName, data['value'])
-                        data['prop'].onActiveLayersChanged()
-                    else:
-                        data['prop'].set(data['value'], force=True)
+        self.rehydrate()
+        for (layer, itemId, propName), data in self.data.items():
+            if layer:
+                layer.setItemProperty(itemId, propName, data['value'])
+                data['prop'].item.updateLayeredProperties([propName])
+            else:
+                data['prop'].set(data['value'], force=True)
 
     def undo(self):
-        for layer, itemData in self.data.items():
-            for itemId, props in itemData.items():
-                for propName, data in props.items():
-                    if layer:
-                        if data['wasSet'] and 'was' in data:
-                            layer.setItemProperty(itemId, propName, data['was'])
-                        else:
-                            layer.resetItemProperty(data['prop'])
-                        data['prop'].onActiveLayersChanged()
-                    else:
-                        if data['wasSet'] and 'was' in data:
-                            data['prop'].set(data['was'], force=True)
-                        else:
-                            data['prop'].reset()
-
+        self.rehydrate()
+        for (layer, itemId, propName), data in self.data.items():
+            if layer:
+                if data['wasSet'] and 'was' in data:
+                    layer.setItemProperty(itemId, propName, data['was'])
+                else:
+                    layer.resetItemProperty(data['prop'])
+                data['prop'].item.updateLayeredProperties([propName])
+            else:
+                if data['wasSet'] and 'was' in data:
+                    data['prop'].set(data['was'], force=True)
+                else:
+                    data['prop'].reset()
+
+    def journal(self, undo=False):
+        self.rehydrate()
+        ret = []
+        for (layer, itemId, propName), data in self.data.items():
+            layerId = layer.id if layer else None
+            if not undo:
+                ret.append(('set', layerId, itemId, propName, data['value']))
+            elif data['wasSet'] and 'was' in data:
+                ret.append(('set', layerId, itemId, propName, data['was']))
+            else:
+                ret.append(('reset', layerId, itemId, propName))
+        return ret
 
     def mergeWith(self, other):
-        util.deepMerge(self.data, other.data, ignore='was')
+        """ Keep the first `was`, take the latest `value`. """
+        self.rehydrate()
+        data = self.data
+        for key, entry in other.data.items():
+            mine = data.get(key)
+            if mine is None:
+                data[key] = entry
+            else:
+                mine['value'] = entry['value']
         return True
 
 
+class SetItemProperties(SetItemProperty):
+    """ Set the same value on many props as one command, e.g. from
+    ModelHelper.set() with many items selected. Push before setting the
+    values, like Property.set(undo=) does. `value` is recorded as each
+    prop stores it, see Property.convert().
+    """
+
+    def __init__(self, props, value, id=-1):
+        super().__init__(props[0], props[0].convert(value), layers=props[0]._activeLayers, id=id)
+        for prop in props[1:]:
+            self._addProp(prop, prop.convert(value), prop._activeLayers)
+
+
 class ResetItemProperty(UndoCommand):
-    """ Only used from Property.reset(undo=bool|int). """
+    """ Only used from Property.reset(undo=bool|int).
+
+    `data` is flat, { (layer, itemId, attr): (prop, was) }.
+    """
     def __init__(self, prop, layers=[], id=-1):
-        item = prop.item
         super().__init__('Reset %s' % prop.name(), id)
         self.data = {}
         if prop.layered:
             # only take `was` values stored on selected layers
             for layer in layers:
-                self.data[layer] = {}
                 x, ok = layer.getItemProperty(prop.item.id, prop.name())
                 if ok:
-                    self.data[layer] = {
-                        prop: x
-                    }
+                    self.data[(layer, prop.item.id, prop.name())] = (prop, x)
         else:
-            self.data[None] = {
-                prop: prop.get()
-            }
+            self.data[(None, prop.item.id, prop.name())] = (prop, prop.get())
         self.firstTime = True
 
+    def spillState(self):
+        self._refs = [(layer, prop.item) for (layer, itemId, propName), (prop, was) in self.data.items()]
+        state = [(propName, was) for (layer, itemId, propName), (prop, was) in self.data.items()]
+        self.data = None
+        return state
+
+    def restoreState(self, state):
+        self.data = {}
+        for (layer, item), (propName, was) in zip(self._refs, state):
+            self.data[(layer, item.id, propName)] = (item.prop(propName), was)
+        self._refs = None
+
     def redo(self):
         if self.firstTime:
             self.firstTime = False
             return
-        for layer, propEntry in self.data.items():
-            for prop, was in propEntry.items():
-                if layer:
-                    layer.resetItemProperty(prop)
-                else:
-                    prop.reset()
+        self.rehydrate()
+        for (layer, itemId, propName), (prop, was) in self.data.items():
+            if layer:
+                layer.resetItemProperty(prop)
+                prop.item.updateLayeredProperties([propName])
+            else:
+                prop.reset()
         self.firstTime = False
 
     def undo(self):
-        for layer, propEntry in self.data.items():
-            for prop, was in propEntry.items():
-                if layer:
-                    layer.setItemProperty(prop.item.id, prop.name(), was)
-                else:
-                    prop.set(was)
+        self.rehydrate()
+        for (layer, itemId, propName), (prop, was) in self.data.items():
+            if layer:
+                layer.setItemProperty(itemId, propName, was)
+                prop.item.updateLayeredProperties([propName])
+            else:
+                prop.set(was)
+
+    def journal(self, undo=False):
+        self.rehydrate()
+        ret = []
+        for (layer, itemId, propName), (prop, was) in self.data.items():
+            layerId = layer.id if layer else None
+            if undo:
+                ret.append(('set', layerId, itemId, propName, was))
+            else:
+                ret.append(('reset', layerId, itemId, propName))
+        return ret
 
     def mergeWith(self, other):
-        util.deepMerge(self.data, other.data, ignore='was')
+        """ Keep the first `was`. """
+        self.rehydrate()
+        for key, entry in other.data.items():
+            self.data.setdefault(key, entry)
         return True
 
 
@@ -320,6 +743,11 @@ class AddLayer(UndoCommand):
         for i, layer in enumerate(self.document.layers()):
             self.layer.setOrder(i, notify=False)
 
+    def journal(self, undo=False):
+        if undo:
+            return [('remove', self.layer.id)]
+        return [('add', _itemChunk(self.layer))]
+
 
 def addLayer(document, layer):
     cmd = AddLayer(document, layer)
@@ -347,11 +775,22 @@ class SetLayerOrder(UndoCommand):
             layer.setOrder(i)
         self.document._resortLayersFromOrder()
 
+    def journal(self, undo=False):
+        layers = self.oldLayers if undo else self.newLayers
+        return [('set', None, layer.id, 'order', i) for i, layer in enumerate(layers)]
+
 def setLayerOrder(document, layers):
     stack().push(SetLayerOrder(document, layers))
 
 
 
+def _tagsJournal(items):
+    """ journal() runs right after redo() or undo(), so record the tags as
+    they are now. The document's own tags go under item id None.
+    """
+    return [('set', None, item.id, 'tags', list(item.tags())) for item in items]
+
+
 class CreateTag(UndoCommand):
 
     ANALYTICS = 'Create tag'
@@ -367,6 +806,9 @@ class CreateTag(UndoCommand):
     def undo(self):
         self.document.removeTag(self.tag)
 
+    def journal(self, undo=False):
+        return _tagsJournal([self.document])
+
 def createTag(*args):
     stack().push(CreateTag(*args))
 
@@ -392,6 +834,9 @@ class DeleteTag(UndoCommand):
         for item in self.items:
             item.setTag(self.tag)
 
+    def journal(self, undo=False):
+        return _tagsJournal([self.document] + list(self.items))
+
 
 def deleteTag(*args):
     stack().push(DeleteTag(*args))
@@ -413,6 +858,9 @@ class RenameTag(UndoCommand):
     def undo(self):
         self.document.renameTag(self.new, self.old)
 
+    def journal(self, undo=False):
+        return _tagsJournal([self.document] + self.document.find(tags=self.old if undo else self.new))
+
 
 def renameTag(*args):
     stack().push(RenameTag(*args))
@@ -433,6 +881,9 @@ class SetTag(UndoCommand):
     def undo(self):
         self.item.unsetTag(self.tag)
 
+    def journal(self, undo=False):
+        return _tagsJournal([self.item])
+
 
 def setTag(*args):
     stack().push(SetTag(*args))
@@ -453,6 +904,9 @@ class UnsetTag(UndoCommand):
     def undo(self):
         self.item.setTag(self.tag)
 
+    def journal(self, undo=False):
+        return _tagsJournal([self.item])
+
 
 def unsetTag(*args):
     stack().push(UnsetTag(*args))
@@ -0,0 +1,73 @@
+""" Per-command-class timing and size histograms for UndoStack.
+
+    commands.stack().setInstrumented(True)
+    ...
+    print(commands.stack().stats().toJson())
+"""
+
+import json
+
+
+class Histogram:
+    """ Power-of-two buckets, e.g. of microseconds or bytes. """
+
+    __slots__ = ('count', 'total', 'max', 'buckets')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.buckets = {} # bit length -> count
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        bucket = int(value).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def toDict(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else 0,
+            'max': self.max,
+            'buckets': { '<%i' % (1 << bucket): n for bucket, n in sorted(self.buckets.items()) }
+        }
+
+
+class CommandStats:
+    """ {command class name: {measure: Histogram}}. Times are in
+    microseconds. Measures are 'push', 'merge' (a push that merged into
+    the previous command), 'undo', 'redo', and 'bytes' (sizeEstimate()
+    after push).
+    """
+
+    def __init__(self):
+        self._byClass = {}
+
+    def record(self, className, measure, value):
+        measures = self._byClass.get(className)
+        if measures is None:
+            measures = self._byClass[className] = {}
+        histogram = measures.get(measure)
+        if histogram is None:
+            histogram = measures[measure] = Histogram()
+        histogram.add(value)
+
+    def count(self, className, measure):
+        histogram = self._byClass.get(className, {}).get(measure)
+        return histogram.count if histogram else 0
+
+    def clear(self):
+        self._byClass = {}
+
+    def report(self):
+        return {
+            className: { measure: histogram.toDict() for measure, histogram in measures.items() }
+            for className, measures in self._byClass.items()
+        }
+
+    def toJson(self):
+        return json.dumps(self.report(), indent=4, sort_keys=True)
@@ -0,0 +1,109 @@
+""" Binary document container that can be opened with mmap.
+
+    magic
+    records     length-prefixed pickles, see stream.writeRecord()
+    toc         { 'document': offset,
+                  'items': { id: (kind, offset) },
+                  'overrides': { layerId: offset },
+                  'savePoint': token }
+    footer      toc offset, magic
+
+Layer itemProperties are stored in their own override blocks rather than
+in the layer record. The table of contents lets DocumentFile read any one
+item without touching the rest of the file.
+"""
+
+import os, mmap, struct, pickle
+from . import stream
+
+
+MAGIC = b'QTBRDOC1'
+_OFFSET = struct.Struct('<Q')
+
+
+def writeContainer(document, path):
+    """ Write `document` to `path`, one item record at a time. Goes
+    through a temp file since `path` may be mapped by the DocumentFile
+    `document` was opened from.
+    """
+    document.materializeAll()
+    toc = { 'items': {}, 'overrides': {}, 'savePoint': document._newSavePoint() }
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        f.write(MAGIC)
+        chunk = {}
+        document.write(chunk)
+        toc['document'] = f.tell()
+        stream.writeRecord(f, chunk)
+        for item in list(document.itemRegistry.values()):
+            chunk = {}
+            item.write(chunk)
+            if item.isLayer:
+                toc['overrides'][item.id] = f.tell()
+                stream.writeRecord(f, chunk.pop('itemProperties', {}))
+            toc['items'][item.id] = (item.__class__.__name__, f.tell())
+            stream.writeRecord(f, chunk)
+        tocOffset = f.tell()
+        stream.writeRecord(f, toc)
+        f.write(_OFFSET.pack(tocOffset))
+        f.write(MAGIC)
+    os.replace(tmpPath, path)
+    document._clearJournal()
+
+
+class DocumentFile:
+    """ Read-only, memory-mapped view of a container file. """
+
+    def __init__(self, path, kinds=None):
+        self.path = path
+        self._kinds = kinds if kinds is not None else stream.itemKinds()
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        footer = len(self._map) - _OFFSET.size - len(MAGIC)
+        if footer < len(MAGIC) or self._map[:len(MAGIC)] != MAGIC or self._map[-len(MAGIC):] != MAGIC:
+            self.close()
+            raise ValueError('Not a document container: %s' % path)
+        tocOffset, = _OFFSET.unpack_from(self._map, footer)
+        self._toc = self._record(tocOffset)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _record(self, offset):
+        length, = _OFFSET.unpack_from(self._map, offset)
+        start = offset + _OFFSET.size
+        with memoryview(self._map) as view:
+            return pickle.loads(view[start:start + length])
+
+    def savePoint(self):
+        return self._toc.get('savePoint')
+
+    def documentChunk(self):
+        return self._record(self._toc['document'])
+
+    def itemIds(self):
+        return self._toc['items'].keys()
+
+    def layerIds(self):
+        return self._toc['overrides'].keys()
+
+    def kindOf(self, id):
+        return self._toc['items'][id][0]
+
+    def readItem(self, id, byId=None):
+        """ Return a new, unregistered Item for `id`. """
+        kindName, offset = self._toc['items'][id]
+        kind = self._kinds.get(kindName)
+        if kind is None:
+            raise ValueError('Unknown item kind: %s' % kindName)
+        chunk = self._record(offset)
+        if id in self._toc['overrides']:
+            chunk['itemProperties'] = self._record(self._toc['overrides'][id])
+        item = kind()
+        item.read(chunk, byId)
+        return item
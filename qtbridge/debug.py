@@ -20,6 +20,8 @@ def get_class_that_defined_method(meth):
 
 class Debug:
 
+    __slots__ = () # so slotted subclasses like Property stay compact
+
     DEBUG = True
 
     WRITE = print # Avoid PyQt dependency
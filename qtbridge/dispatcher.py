@@ -0,0 +1,132 @@
+import weakref
+from .weakset import WeakOrderedSet
+
+
+class PropertyDispatcher:
+    """ Routes property changes in a Document to the subscribers interested
+    in them, rather than every subscriber listening to every item.
+
+    Subscribers implement onItemProperty(prop), the same as property
+    listeners, and are weakly referenced. Interest is registered by:
+
+        subscribe(x, attr)                  `attr` on any item
+        subscribe(x, attr, itemId=3)        `attr` on item 3
+        subscribe(x, attr, kind=Person)     `attr` on instances of Person
+        subscribeItems(x, {3, 4, 5})        any attr on a set of items
+
+    `attr=None` matches every attr. A subscriber matching more than one
+    pattern is called once per change.
+    """
+
+    def __init__(self):
+        self._byItem = {} # (itemId|None, attr|None) -> WeakOrderedSet
+        self._byKind = {} # (class, attr|None) -> WeakOrderedSet
+        self._kindCache = {} # (type(item), attr) -> [WeakOrderedSet], see dispatch()
+        self._selections = {} # id(subscriber) -> (ref, itemIds, attr)
+        self._bySelection = {} # itemId -> WeakOrderedSet, reverse index of _selections
+
+    def _table(self, kind):
+        if kind is not None:
+            self._kindCache = {}
+            return self._byKind
+        return self._byItem
+
+    def subscribe(self, subscriber, attr=None, itemId=None, kind=None):
+        table = self._table(kind)
+        key = (kind if kind is not None else itemId, attr)
+        subscribers = table.get(key)
+        if subscribers is None:
+            subscribers = table[key] = WeakOrderedSet()
+        subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber, attr=None, itemId=None, kind=None):
+        table = self._table(kind)
+        key = (kind if kind is not None else itemId, attr)
+        subscribers = table.get(key)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del table[key]
+
+    def subscribeItems(self, subscriber, itemIds, attr=None):
+        """ Replace `subscriber`'s selection with `itemIds`, e.g. for a model
+        of the selected items. """
+        self.unsubscribeItems(subscriber)
+        key = id(subscriber)
+        itemIds = frozenset(itemIds)
+        def onCollected(ref):
+            entry = self._selections.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._selections[key]
+                self._dropEmpty(itemIds)
+        self._selections[key] = (weakref.ref(subscriber, onCollected), itemIds, attr)
+        for itemId in itemIds:
+            subscribers = self._bySelection.get(itemId)
+            if subscribers is None:
+                subscribers = self._bySelection[itemId] = WeakOrderedSet()
+            subscribers.add(subscriber)
+
+    def unsubscribeItems(self, subscriber):
+        entry = self._selections.pop(id(subscriber), None)
+        if entry is not None:
+            for itemId in entry[1]:
+                subscribers = self._bySelection.get(itemId)
+                if subscribers is not None:
+                    subscribers.discard(subscriber)
+            self._dropEmpty(entry[1])
+
+    def _dropEmpty(self, itemIds):
+        for itemId in itemIds:
+            subscribers = self._bySelection.get(itemId)
+            if subscribers is not None and not subscribers:
+                del self._bySelection[itemId]
+
+    def subscriberCount(self):
+        """ Number of (pattern, subscriber) registrations, for profiling. """
+        return (sum(len(x) for x in self._byItem.values()) +
+                sum(len(x) for x in self._byKind.values()) +
+                len(self._selections))
+
+    def dispatch(self, prop):
+        item = prop.item
+        attr = prop.meta.attr
+        buckets = []
+        if self._byItem:
+            byItem = self._byItem
+            for key in ((item.id, attr), (item.id, None), (None, attr), (None, None)):
+                subscribers = byItem.get(key)
+                if subscribers:
+                    buckets.append(subscribers)
+        if self._byKind:
+            kind = type(item)
+            kindBuckets = self._kindCache.get((kind, attr))
+            if kindBuckets is None:
+                kindBuckets = []
+                for cls in kind.__mro__:
+                    for key in ((cls, attr), (cls, None)):
+                        subscribers = self._byKind.get(key)
+                        if subscribers is not None:
+                            kindBuckets.append(subscribers)
+                self._kindCache[(kind, attr)] = kindBuckets
+            buckets.extend(kindBuckets)
+        selected = []
+        if self._bySelection:
+            subscribers = self._bySelection.get(item.id)
+            if subscribers:
+                for subscriber in subscribers:
+                    entry = self._selections.get(id(subscriber))
+                    if entry is not None and (entry[2] is None or entry[2] == attr):
+                        selected.append(subscriber)
+        if not buckets and not selected:
+            return
+        if len(buckets) == 1 and not selected:
+            subscribers = buckets[0]
+        else:
+            seen = set()
+            subscribers = []
+            for x in [x for bucket in buckets for x in bucket] + selected:
+                if not id(x) in seen:
+                    seen.add(id(x))
+                    subscribers.append(x)
+        for subscriber in subscribers:
+            subscriber.onItemProperty(prop)
@@ -1,6 +1,13 @@
-from .pyqt import pyqtSignal, QDate
+import os, uuid, contextlib, concurrent.futures
+from .pyqt import pyqtSignal, QDate, QTimer
+from . import commands, stream
 from .item import Item
-from .property import Property
+from .property import Property, beginCoalescing, endCoalescing
+from .itemindex import ItemIndex
+from .layercomposite import LayerComposite
+from .container import DocumentFile
+from .snapshot import DocumentSnapshot, frozenChunk
+from .dispatcher import PropertyDispatcher
 
 
 
@@ -9,6 +16,9 @@ class Document(Item):
     """ Contains all of the items. Manages unique item ids. """
 
     _isDocument = True
+    _itemIndex = None
+    _lazyFile = None
+    _idPool = None # iterator over reserveIds() drawn from by nextId()
 
     itemAdded = pyqtSignal(Item)
     itemRemoved = pyqtSignal(Item)
@@ -18,24 +28,67 @@ class Document(Item):
     layerRemoved = pyqtSignal(Layer)
     activeLayersChanged = pyqtSignal(list)
     layerOrderChanged = pyqtSignal()
+    changesCommitted = pyqtSignal(dict) # once per transaction(): { 'added': [], 'removed': [], 'changed': [] }
+    # Batched forms of itemAdded/itemRemoved/propertyChanged, once per batch.
+    # Outside a batch, adds/removes are emitted right away and property
+    # changes are coalesced until the next event loop tick.
+    itemsAdded = pyqtSignal(list)
+    itemsRemoved = pyqtSignal(list)
+    propertiesChanged = pyqtSignal(list)
+    saveFinished = pyqtSignal(str, bool) # path, ok; from saveInBackground()
 
     Item.registerProperties((
         { 'attr': 'lastItemId', 'default': -1, 'notify': False },
     ))
 
     def __init__(self, *args, **kwargs):
+        self.clearDirty() # Item.__init__ stores props
         super().__init__(*args, **kwargs)
         self._isInitializing = True
         self._batchAddRemoveStackLevel = 0
+        self._batchAddedItems = []
+        self._batchRemovedItems = []
+        self._transactionLevel = 0
+        self._pendingAdded = {}
+        self._pendingRemoved = {}
+        self._pendingChanged = {}
+        self._pendingActiveLayers = False
+        self._queuedAdded = {}
+        self._queuedRemoved = {}
+        self._queuedChanged = {}
+        self._flushScheduled = False
         self._updatingAll = False # indicates a static update is occuring, i.e. no animations, etc
         self._areActiveLayersChanging = False
         self._itemRegistry = {}
         self._layers = []
         self._activeLayers = []
+        self._layerComposite = LayerComposite()
+        self._lazyIds = set()
+        self._snapshotPath = None
+        self._snapshotSize = 0
+        self._deltaCount = 0
+        self._savePoint = None
+        self._snapshotChunks = None # id -> frozen chunk, once snapshot() is used
+        self._staleChunks = set()
+        self._saveExecutor = None
+        self._pendingSave = None
+        self._savingDirty = None # dirty state taken by saveInBackground()
+        self.saveFinished.connect(self._onSaveFinished)
+        self._dispatcher = PropertyDispatcher()
 
     def nextId(self):
-        self.setLastItemId(self.lastItemId() + 1)
-        return self.lastItemId()
+        if self._idPool is not None:
+            id = next(self._idPool, None)
+            if id is not None:
+                return id
+        return self.reserveIds(1)[0]
+
+    def reserveIds(self, n):
+        """ Return a range of `n` unused ids, with one write to lastItemId. """
+        first = self.lastItemId() + 1
+        if n > 0:
+            self.setLastItemId(first + n - 1)
+        return range(first, first + n)
 
     def addItem(self, item, register=True):
         if (isinstance(item, QGraphicsItem) or isinstance(item, QGraphicsObject)) and not item.document() is self:
@@ -50,6 +103,9 @@ class Document(Item):
             elif self.itemRegistry.get(item.id, None) is item: # already registered
                 return
             self.itemRegistry[item.id] = item
+            if self._itemIndex is not None:
+                self._itemIndex.add(item)
+            self._markAdded(item)
         ## Signals
         if not self.isBatchAddingRemovingItems():
             item.updateAll()
@@ -62,36 +118,171 @@ class Document(Item):
             if not self.isBatchAddingRemovingItems():
                 if item.active():
                     self.updateActiveLayers()
-        item.addPropertyListener(self)
-        item.onRegistered(self)
-        if self.isBatchAddingRemovingItems() and not item in self._batchAddedItems:
+            elif self._transactionLevel and item.active():
+                self._pendingActiveLayers = True
+        item.onRegistered(self) # Item.onProperty() calls onItemProperty() from here on
+        attrs = self._layerComposite.values().get(item.id)
+        if attrs: # updateActiveLayers() won't see items added after their layers
+            item.updateLayeredProperties(attrs)
+        if self.isBatchAddingRemovingItems() and not id(item) in self._batchAddedIds:
+            self._batchAddedIds.add(id(item))
             self._batchAddedItems.append(item)
-        self.itemAdded.emit(item)
+        if self._transactionLevel:
+            if self._pendingRemoved.pop(id(item), None) is None:
+                self._pendingAdded[id(item)] = item
+        else:
+            self.itemAdded.emit(item)
+            self._queueBatched(self._queuedAdded, self._queuedRemoved, item)
         return item
 
     def addItems(self, *args):
         self.setBatchAddingRemovingItems(True)
+        items = [x for x in args if isinstance(x, Item)]
+        maxId = max((x.id for x in items if x.id is not None), default=-1)
+        if maxId > self.lastItemId():
+            self.setLastItemId(maxId) # bump once, not per item
+        ids = iter(self.reserveIds(len([x for x in items if x.id is None])))
         for item in args:
+            if isinstance(item, Item) and item.id is None:
+                item.id = next(ids)
             self.addItem(item)
         self.setBatchAddingRemovingItems(False)
 
+    def cloneItems(self, items):
+        """ Clone `items` into this document as one batch, e.g. for paste.
+        Ids come from a single reserveIds() block.
+        """
+        self.setBatchAddingRemovingItems(True)
+        self._idPool = iter(self.reserveIds(len(items)))
+        try:
+            clones = [item.clone(self) for item in items]
+        finally:
+            self._idPool = None
+            self.setBatchAddingRemovingItems(False)
+        return clones
+
     def isBatchAddingRemovingItems(self):
         return self._batchAddRemoveStackLevel > 0
 
     def setBatchAddingRemovingItems(self, on):
         if on:
             self._batchAddRemoveStackLevel += 1
-            self._batchAddedItems = []
-            self._batchRemovedItems = []
+            if self._batchAddRemoveStackLevel == 1:
+                self._batchAddedItems = []
+                self._batchRemovedItems = []
+                self._batchAddedIds = set()
+                self._batchRemovedIds = set()
         else:
             self._batchAddRemoveStackLevel -= 1
             assert self._batchAddRemoveStackLevel >= 0
             if self._batchAddRemoveStackLevel == 0:
                 if len([x for x in (self._batchAddedItems + self._batchRemovedItems) if isinstance(x, Layer)]) > 0:
                     self._tidyLayerOrder()
-                self.updateAll()
+                    if self._transactionLevel:
+                        self._pendingActiveLayers = True
+                    else:
+                        self.updateActiveLayers()
+                if self._batchAddedItems or self._batchRemovedItems or not self._transactionLevel:
+                    self.updateAll()
                 self._batchAddedItems = []
                 self._batchRemovedItems = []
+                self.flushBatchedSignals()
+
+    def _queueBatched(self, queue, opposite, item):
+        """ Queue `item` for itemsAdded/itemsRemoved. Structural changes are
+        flushed immediately outside of a batch so models stay consistent.
+        """
+        if opposite.pop(id(item), None) is None:
+            queue[id(item)] = item
+        if not self.isBatchAddingRemovingItems():
+            self.flushBatchedSignals()
+
+    def flushBatchedSignals(self):
+        """ Emit queued itemsAdded, itemsRemoved, and propertiesChanged. """
+        added = list(self._queuedAdded.values())
+        removed = list(self._queuedRemoved.values())
+        changed = [prop for prop in self._queuedChanged.values()
+                   if prop.item is not None and prop.item.document() is self]
+        self._queuedAdded = {}
+        self._queuedRemoved = {}
+        self._queuedChanged = {}
+        if removed:
+            self.itemsRemoved.emit(removed)
+        if added:
+            self.itemsAdded.emit(added)
+        if changed:
+            self.propertiesChanged.emit(changed)
+
+    @contextlib.contextmanager
+    def transaction(self, text='Edit'):
+        """ Batch add/remove items and coalesce everything inside into one
+        changesCommitted signal and one undo macro.
+
+        itemAdded, itemRemoved, propertyChanged, and layerChanged are held
+        until the outermost transaction ends and then emitted once per item
+        or (item, attr). So are Item.onProperty() calls, and with them
+        property listeners and the dispatcher(), unless notifications are
+        already being coalesced, e.g. in an undo step. Active layers are
+        updated once at the end.
+
+            with document.transaction('Import'):
+                for chunk in chunks:
+                    document.addItem(Person(**chunk))
+        """
+        self._transactionLevel += 1
+        coalescing = False
+        if self._transactionLevel == 1:
+            commands.stack().openMacro(text)
+            coalescing = beginCoalescing()
+        self.setBatchAddingRemovingItems(True)
+        try:
+            yield self
+        finally:
+            if coalescing:
+                endCoalescing() # into _pendingChanged via onItemProperty()
+            self.setBatchAddingRemovingItems(False)
+            self._transactionLevel -= 1
+            if self._transactionLevel == 0:
+                commands.stack().closeMacro()
+                self._commitTransaction()
+
+    def isInTransaction(self):
+        return self._transactionLevel > 0
+
+    def _commitTransaction(self):
+        added = list(self._pendingAdded.values())
+        removed = list(self._pendingRemoved.values())
+        changed = self._pendingChanged
+        updateActiveLayers = self._pendingActiveLayers
+        self._pendingAdded = {}
+        self._pendingRemoved = {}
+        self._pendingChanged = {}
+        self._pendingActiveLayers = False
+        if updateActiveLayers:
+            self.updateActiveLayers()
+        for item in added:
+            self.itemAdded.emit(item)
+            self._queuedAdded[id(item)] = item
+        for item in removed:
+            self.itemRemoved.emit(item)
+            self._queuedRemoved[id(item)] = item
+        emitted = []
+        for key, prop in changed.items():
+            if prop.item is None or prop.item.document() is not self:
+                continue # removed in the same transaction
+            if prop.item.isLayer:
+                self.layerChanged.emit(prop)
+            self.propertyChanged.emit(prop)
+            self._queuedChanged[key] = prop
+            emitted.append(prop)
+        self.flushBatchedSignals()
+        changed = emitted
+        if added or removed or changed:
+            self.changesCommitted.emit({
+                'added': added,
+                'removed': removed,
+                'changed': changed
+            })
 
     def removeItem(self, item):
         if not isinstance(item, Item):
@@ -100,24 +291,392 @@ class Document(Item):
         if not item.id in self.itemRegistry:
             return
         del self.itemRegistry[item.id]
+        if self._itemIndex is not None:
+            self._itemIndex.remove(item)
+        self._markRemoved(item)
         item.onDeregistered(self)
-        item.removePropertyListener(self)
         # I think it's ok to skip signals when deinitializing
         if self.isDeinitializing:
             return
         ## Signals
         if item.isLayer:
             self._layers.remove(item)
-            self._tidyLayerOrder()
+            if not self.isBatchAddingRemovingItems():
+                self._tidyLayerOrder()
             self.layerRemoved.emit(item)
-        if self.isBatchAddingRemovingItems() and not item in self._batchRemovedItems:
+            if item in self._activeLayers:
+                if self._transactionLevel:
+                    self._pendingActiveLayers = True
+                elif not self.isBatchAddingRemovingItems(): # else at the end of the batch
+                    self.updateActiveLayers()
+        if self.isBatchAddingRemovingItems() and not id(item) in self._batchRemovedIds:
+            self._batchRemovedIds.add(id(item))
             self._batchRemovedItems.append(item)
-        self.itemRemoved.emit(item)
+        if self._transactionLevel:
+            if self._pendingAdded.pop(id(item), None) is None:
+                self._pendingRemoved[id(item)] = item
+        else:
+            self.itemRemoved.emit(item)
+            self._queueBatched(self._queuedRemoved, self._queuedAdded, item)
+
+    def removeItems(self, *args):
+        """ Remove many items as one batch: layer order and active layers
+        are updated once, itemsRemoved is emitted once, and the overrides
+        the remaining layers hold for the removed items are reset with one
+        call per layer. """
+        self.setBatchAddingRemovingItems(True)
+        itemIds = set()
+        for item in args:
+            if isinstance(item, Item) and self.itemRegistry.get(item.id) is item:
+                itemIds.add(item.id)
+            self.removeItem(item)
+        if itemIds:
+            for layer in self.layers():
+                values = layer.overrides().valuesFor(itemIds)
+                if values:
+                    layer.resetItemPropertiesMany([(itemId, attr)
+                                                   for itemId, attrs in values.items()
+                                                   for attr in attrs])
+        self.setBatchAddingRemovingItems(False)
+
+    def dispatcher(self):
+        """ Subscribe here for changes to many items instead of adding a
+        property listener to each one. """
+        return self._dispatcher
+
+    def onItemProperty(self, prop):
+        """ Called from Item.onProperty() for every registered item. """
+        self._dispatcher.dispatch(prop)
+        if self._itemIndex is not None:
+            self._itemIndex.update(prop.item, prop.name())
+        if self._transactionLevel:
+            self._pendingChanged[(id(prop.item), prop.name())] = prop
+            if prop.item.isLayer and prop.name() == 'active':
+                self._pendingActiveLayers = True
+            return
+        if prop.item.isLayer:
+            if prop.name() == 'active':
+                self.updateActiveLayers()
+            self.layerChanged.emit(prop)
+        self.propertyChanged.emit(prop)
+        self._queuedChanged[(id(prop.item), prop.name())] = prop
+        if not self.isBatchAddingRemovingItems() and not self._flushScheduled:
+            self._flushScheduled = True
+            QTimer.singleShot(0, self._onFlushTimer)
+
+    def _onFlushTimer(self):
+        self._flushScheduled = False
+        self.flushBatchedSignals()
+
+    ## Dirty tracking
+
+    def clearDirty(self):
+        """ Called after the document was written or read in full. """
+        self._dirtyDocument = set() # attrs
+        self._dirtyDocumentChunk = False # see Item.markChunkDirty()
+        self._dirtyAdded = {} # id -> item
+        self._dirtyRewritten = set() # ids, see Item.markChunkDirty()
+        self._dirtyChanged = {} # id -> {attr}
+        self._dirtyLayerValues = {} # layer id -> {(itemId, attr)}
+        self._dirtyRemoved = set() # ids
+
+    def isDirty(self):
+        return bool(self._dirtyDocument or self._dirtyDocumentChunk or self._dirtyAdded or
+                    self._dirtyRewritten or self._dirtyChanged or self._dirtyLayerValues or
+                    self._dirtyRemoved or self._savingDirty is not None)
+
+    def _takeDirty(self):
+        """ Return the dirty state and start a new one. """
+        state = (self._dirtyDocument, self._dirtyDocumentChunk, self._dirtyAdded,
+                 self._dirtyRewritten, self._dirtyChanged, self._dirtyLayerValues,
+                 self._dirtyRemoved)
+        self.clearDirty()
+        return state
+
+    def _restoreDirty(self, state):
+        """ Merge back what _takeDirty() returned. Marks made since take
+        precedence, e.g. for an item added before and removed since.
+        """
+        document, documentChunk, added, rewritten, changed, layerValues, removed = state
+        self._dirtyDocument |= document
+        self._dirtyDocumentChunk = self._dirtyDocumentChunk or documentChunk
+        for id, item in added.items():
+            if id in self._dirtyRemoved:
+                self._dirtyRemoved.discard(id) # never saved
+            else:
+                self._markAdded(self._dirtyAdded.get(id, item))
+        for id in removed:
+            if not id in self._dirtyAdded: # re-adding writes it again
+                self._dirtyRemoved.add(id)
+        def keep(id):
+            return not id in self._dirtyAdded and not id in self._dirtyRemoved
+        self._dirtyRewritten.update(id for id in rewritten if keep(id))
+        for id, attrs in changed.items():
+            if keep(id):
+                self._dirtyChanged.setdefault(id, set()).update(attrs)
+        for id, pairs in layerValues.items():
+            if keep(id):
+                self._dirtyLayerValues.setdefault(id, set()).update(pairs)
+
+    def markDirty(self, item, attr):
+        """ Called from Property whenever a value is stored, and with no
+        `attr` from Item.markChunkDirty() to write the whole item again. """
+        if item is self:
+            if attr is None:
+                self._dirtyDocumentChunk = True
+            else:
+                self._dirtyDocument.add(attr)
+            return
+        if self._snapshotChunks is not None:
+            self._staleChunks.add(item.id)
+        if attr is None:
+            if not item.id in self._dirtyAdded:
+                self._dirtyRewritten.add(item.id)
+        elif not item.id in self._dirtyAdded:
+            attrs = self._dirtyChanged.get(item.id)
+            if attrs is None:
+                attrs = self._dirtyChanged[item.id] = set()
+            attrs.add(attr)
+
+    def _markAdded(self, item):
+        self._dirtyRemoved.discard(item.id)
+        self._dirtyRewritten.discard(item.id)
+        self._dirtyChanged.pop(item.id, None)
+        self._dirtyLayerValues.pop(item.id, None)
+        self._dirtyAdded[item.id] = item
+        if self._snapshotChunks is not None:
+            self._staleChunks.add(item.id)
+
+    def _markRemoved(self, item):
+        if self._snapshotChunks is not None:
+            self._staleChunks.add(item.id)
+        self._dirtyChanged.pop(item.id, None)
+        self._dirtyRewritten.discard(item.id)
+        self._dirtyLayerValues.pop(item.id, None)
+        if self._dirtyAdded.pop(item.id, None) is None:
+            self._dirtyRemoved.add(item.id)
+
+    def saveFull(self, path):
+        """ Write a stream.writeDocument() snapshot and clear the dirty state.
+        Writes to a temp file first, like stream.writeSnapshot(), so `path`
+        can be the file this document was lazily opened from.
+        """
+        self.waitForSave()
+        self.materializeAll() # reads and releases the lazy file before it is replaced
+        self._newSavePoint()
+        tmpPath = path + '.tmp'
+        with open(tmpPath, 'wb') as f:
+            stream.writeDocument(self, f)
+            size = f.tell()
+        os.replace(tmpPath, path)
+        self._snapshotSize = size
+        self._snapshotPath = path
+        self._deltaCount = 0
+        self.clearDirty()
+        self._clearJournal()
+
+    def saveIncremental(self, path, compactAfter=50):
+        """ Append only what changed since the last save to the snapshot at
+        `path`. Rewrites the whole snapshot instead after `compactAfter`
+        deltas, once the deltas outgrow the snapshot, or if `path` is not
+        the last snapshot. Returns True if a full snapshot was written.
+        """
+        self.waitForSave()
+        if (path != self._snapshotPath or not os.path.isfile(path) or
+            self._deltaCount >= compactAfter or
+            os.path.getsize(path) > self._snapshotSize * 2):
+            self.saveFull(path)
+            return True
+        if self.isDirty():
+            self._newSavePoint()
+            with open(path, 'ab') as f:
+                stream.writeDelta(self, f)
+            self._deltaCount += 1
+            self.clearDirty()
+            self._clearJournal()
+        return False
+
+    def savePoint(self):
+        """ Token written with every save and read back on load, so a
+        journal.CommandJournal can tell which save its edits apply to.
+        None for a document that was never saved or loaded.
+        """
+        return self._savePoint
+
+    def _newSavePoint(self):
+        self._savePoint = uuid.uuid4().hex
+        return self._savePoint
+
+    def _clearJournal(self):
+        """ Edits up to here are saved, so they no longer need recovering.
+        saveInBackground() only marks the journal since edits can be made
+        while it runs. """
+        journal = commands.stack().journal()
+        if journal is not None:
+            journal.clear(self._savePoint)
+
+    def snapshot(self):
+        """ Return an immutable DocumentSnapshot of every item. Only items
+        that changed since the last call are written again, i.e. had a
+        Property stored or called Item.markChunkDirty().
+        """
+        self.materializeAll()
+        if self._snapshotChunks is None:
+            self._snapshotChunks = {}
+            stale = self.itemRegistry.keys()
+        else:
+            stale = self._staleChunks
+        for id in stale:
+            item = self.itemRegistry.get(id)
+            if item is None:
+                self._snapshotChunks.pop(id, None)
+            else:
+                self._snapshotChunks[id] = frozenChunk(item)
+        self._staleChunks = set()
+        documentChunk = {}
+        self.write(documentChunk)
+        chunks = self._snapshotChunks
+        return DocumentSnapshot(documentChunk, [chunks[id] for id in self.itemRegistry], self._savePoint)
+
+    def saveInBackground(self, path, compress=False):
+        """ Take a snapshot() here, then serialize and write it on a worker
+        thread. Emits saveFinished(path, ok) and returns the future. The
+        document stays dirty until the write succeeded.
+        """
+        self.waitForSave()
+        savePoint = self._newSavePoint()
+        snapshot = self.snapshot()
+        self._savingDirty = self._takeDirty() # put back if the write fails
+        journal = commands.stack().journal()
+        if journal is not None: # later edits go on top of this save, if it succeeds
+            journal.mark(savePoint)
+        self._snapshotPath = None # deltas only go after a saveFull()
+        if self._saveExecutor is None:
+            self._saveExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        future = self._saveExecutor.submit(stream.writeSnapshot, snapshot, path, compress=compress)
+        self._pendingSave = future
+        # emit once `future` is done so _onSaveFinished() can read it
+        future.add_done_callback(lambda future: self.saveFinished.emit(path, future.exception() is None))
+        return future
+
+    def waitForSave(self):
+        """ Block until the last saveInBackground() is done. """
+        if self._pendingSave is not None:
+            concurrent.futures.wait([self._pendingSave])
+            self._finishSave()
+
+    def _onSaveFinished(self, path, ok):
+        self._finishSave()
+
+    def _finishSave(self):
+        """ On the GUI thread, after the worker is done. Either this or
+        waitForSave() gets there first. """
+        future = self._pendingSave
+        if future is None or not future.done():
+            return # a later save is running
+        self._pendingSave = None
+        if future.exception() is not None:
+            self._restoreDirty(self._savingDirty)
+        self._savingDirty = None
+
+    ## Lazy loading
+
+    def openLazy(self, path, kinds=None):
+        """ Open a container.writeContainer() file. Layers are loaded right
+        away, every other item is only read from the file on the first
+        find(id=...) or scan that needs it.
+
+        saveFull() and saveIncremental() write the stream format, which
+        this can't read, so save with container.writeContainer() to keep
+        the file lazily loadable. Either one loads every item first.
+        """
+        self._lazyFile = DocumentFile(path, kinds)
+        self._lazyIds = set(self._lazyFile.itemIds())
+        self.read(self._lazyFile.documentChunk(), self.findById)
+        self._savePoint = self._lazyFile.savePoint()
+        layerIds = list(self._lazyFile.layerIds())
+        self._lazyIds.difference_update(layerIds)
+        self.addItems(*[self._lazyFile.readItem(id, self.findById) for id in layerIds])
+        self.clearDirty()
+
+    def isLazy(self):
+        return bool(self._lazyFile is not None and self._lazyIds)
+
+    def unloadedCount(self):
+        return len(self._lazyIds) if self._lazyFile is not None else 0
+
+    def _materialize(self, id):
+        if not id in self._lazyIds:
+            return None
+        self._lazyIds.discard(id) # before read() so reference cycles resolve to None
+        item = self._lazyFile.readItem(id, self.findById)
+        # Already part of the document, so register it without add signals,
+        # dirty tracking, or updateAll().
+        if isinstance(item, QGraphicsItem) or isinstance(item, QGraphicsObject):
+            super().addItem(item)
+        self.itemRegistry[id] = item
+        if self._itemIndex is not None:
+            self._itemIndex.add(item)
+        item.onRegistered(self)
+        attrs = self._layerComposite.values().get(id)
+        if attrs:
+            item.updateLayeredProperties(attrs)
+        return item
+
+    def materializeAll(self):
+        """ Read every item that hasn't been loaded yet and release the file. """
+        if self._lazyFile is None:
+            return
+        for id in sorted(self._lazyIds):
+            self._materialize(id)
+        self.closeLazy()
+
+    def closeLazy(self):
+        """ Release the file. Anything not loaded yet is dropped. """
+        if self._lazyFile is not None:
+            self._lazyFile.close()
+            self._lazyFile = None
+            self._lazyIds = set()
 
     ## Query interface
-            
+
+    def enableIndexes(self, attrs=()):
+        """ Maintain indexes by class, tag, and the values of `attrs` so
+        find(), query() and itemsWithTags() don't scan every item.
+        """
+        self.materializeAll()
+        self._itemIndex = ItemIndex(attrs)
+        for item in self.itemRegistry.values():
+            self._itemIndex.add(item)
+
+    def disableIndexes(self):
+        self._itemIndex = None
+
+    def isIndexed(self, attr=None):
+        if self._itemIndex is None:
+            return False
+        elif attr is None:
+            return True
+        else:
+            return self._itemIndex.isIndexed(attr)
+
     def query(self, **kwargs):
         """ Query based on property value. """
+        self.materializeAll()
+        if self._itemIndex is not None and all(self._itemIndex.isIndexed(k) for k in kwargs):
+            counts = {}
+            for k, v in kwargs.items():
+                matches = self._itemIndex.withValue(k, v)
+                if matches is None: # unhashable value
+                    counts = None
+                    break
+                for item in matches:
+                    counts[item] = counts.get(item, 0) + 1
+            if counts is not None:
+                ret = []
+                for item in self._itemIndex.sorted({item.id: item for item in counts}):
+                    ret.extend([item] * counts[item]) # one per matching kwarg, same as the scan
+                return ret
         ret = []
         for id, item in self.itemRegistry.items():
             for k, v in kwargs.items():
@@ -135,7 +694,10 @@ class Document(Item):
         """ Match is AND. """
         if id is not None: # exclusive; most common use case
             ret = self.itemRegistry.get(id, None)
+            if ret is None and self._lazyFile is not None:
+                ret = self._materialize(id)
         else:
+            self.materializeAll()
             if types is not None:
                 if isinstance(types, list):
                     types = tuple(types)
@@ -145,6 +707,8 @@ class Document(Item):
                 if not isinstance(tags, list):
                     tags = [tags]
             _reverseTags = self.reverseTags() # cache
+            if self._itemIndex is not None:
+                return self._findIndexed(tags, _reverseTags, types, sort)
             ret = []
             for id, item in self.itemRegistry.items():
                 if types is not None and not isinstance(item, types):
@@ -157,19 +721,97 @@ class Document(Item):
         else:
             return ret
 
+    def _findIndexed(self, tags, reverseTags, types, sort):
+        matches = None
+        if types is not None:
+            matches = self._itemIndex.ofTypes(types)
+        if tags is not None:
+            tagged = self._itemIndex.withTags(tags, reverseTags)
+            if tagged is not None:
+                if matches is None:
+                    matches = tagged
+                else:
+                    if len(tagged) < len(matches):
+                        matches, tagged = tagged, matches
+                    matches = {id: item for id, item in matches.items() if id in tagged}
+        if matches is None:
+            ret = list(self.itemRegistry.values())
+        else:
+            ret = self._itemIndex.sorted(matches)
+        if sort:
+            return Property.sortBy(ret, sort)
+        else:
+            return ret
+
     def findById(self, id):
         if id is not None:
             return self.find(id=id)
 
     def itemsWithTags(self, tags=[], kind=Item):
+        self.materializeAll()
+        if self._itemIndex is not None:
+            matches = self._itemIndex.ofTypes(kind)
+            tagged = self._itemIndex.withTags(tags, [])
+            if tagged is not None:
+                matches = {id: item for id, item in tagged.items() if id in matches}
+            return sorted(matches.values())
         ret = []
         for id, item in self.itemRegistry.items():
-            if isinstance(item, kind) and item.hasTags(tags):
+            if isinstance(item, kind) and item.hasTags(tags, []):
                 ret.append(item)
         return sorted(ret)
 
     ## Layers
 
+    def layers(self):
+        return list(self._layers)
+
+    def activeLayers(self):
+        """ Last layer takes precedence. """
+        return list(self._activeLayers)
+
+    def areActiveLayersChanging(self):
+        return self._areActiveLayersChanging
+
+    def layerComposite(self):
+        """ Merged values of the active layers. """
+        return self._layerComposite
+
+    def updateActiveLayers(self):
+        """ Only (itemId, attr) pairs whose merged layer value differs
+        between the old and new active layers are re-read and notified.
+        Everything else keeps its cached layer value.
+        """
+        was = self._activeLayers
+        self._activeLayers = [layer for layer in self._layers if layer.active()]
+        if self._activeLayers == was:
+            return
+        self._applyLayerComposite(self._layerComposite.setLayers(self._activeLayers))
+        self.activeLayersChanged.emit(self.activeLayers())
+
+    def onLayerItemPropertiesChanged(self, layer, itemId=None, attr=None):
+        """ Called from Layer whenever its itemProperties change. """
+        if itemId is None:
+            self.markDirty(layer, 'itemProperties')
+        else:
+            if not layer.id in self._dirtyAdded:
+                self._dirtyLayerValues.setdefault(layer.id, set()).add((itemId, attr))
+            if self._snapshotChunks is not None:
+                self._staleChunks.add(layer.id)
+        was = self._layerComposite.onLayerChanged(layer, itemId, attr)
+        if was is not None: # whole dict replaced on an active layer
+            self._applyLayerComposite(was)
+
+    def _applyLayerComposite(self, was):
+        if self.hideLayers():
+            return
+        self._areActiveLayersChanging = True
+        for itemId, attrs in LayerComposite.diff(was, self._layerComposite.values()).items():
+            item = self.itemRegistry.get(itemId)
+            if item is not None:
+                item.updateLayeredProperties(attrs)
+        self._areActiveLayersChanging = False
+
     def _resortLayersFromOrder(self):
         # re-sort iternal layer list.
         was = list(self._layers)
@@ -1,18 +1,22 @@
 import copy
 from ..pyqt import QDate
 from ..util import Debug
-from .property import Property
+from .property import Property, PropertySchema
+from .weakset import WeakOrderedSet
 
 
 
 CLASS_PROPERTIES = { }
+_CLASS_PROPERTIES_CACHE = { } # class -> entries
 
 
 class Item(Debug):
     """Anything that is stored in the diagram. Has a unique id, write()
     and save() API, and property system. """
 
-    
+    _isDocument = False
+    isLayer = False
+
     @staticmethod
     def registerProperties(propAttrs):
         # set type attr
@@ -28,19 +32,69 @@ class Item(Debug):
         classScope = inspect.currentframe().f_back.f_locals
         __qualname__ = classScope['__qualname__']
         CLASS_PROPERTIES[__qualname__] = propAttrs
-        
+        _CLASS_PROPERTIES_CACHE.clear() # `Item` isn't bound yet when called from its own body
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._compileClassProperties()
+
+    @classmethod
+    def _compileClassProperties(cls):
+        """ Build the class-level accessors and shared PropertySchema once per
+        class so that constructing an item doesn't touch property metadata.
+        """
+        cls._schema = PropertySchema(Item.classProperties(cls))
+        for kwargs in CLASS_PROPERTIES.get(cls.__qualname__, []):
+            attr = kwargs['attr']
+            if attr in ['properties', 'opacity']:
+                raise ValueError('`%s` is a reserved method name for Item' % attr)
+            for name, method in Item._propertyAccessors(attr).items():
+                if not hasattr(cls, name):
+                    setattr(cls, name, method)
+
+    @staticmethod
+    def _propertyAccessors(attr):
+        """ Return the getter, setter, and resetter for `attr` that route to
+        the instance value storage without allocating a Property.
+        """
+        def getter(self, forLayers=None):
+            return Property.valueOf(self, self._schema.byAttr[attr], forLayers)
+
+        def setter(self, x, notify=True, undo=None, forLayers=None, force=False):
+            return self.prop(attr).set(x, notify=notify, undo=undo, forLayers=forLayers, force=force)
+
+        def resetter(self, notify=True, undo=None):
+            return self.prop(attr).reset(notify=notify, undo=undo)
+
+        setterName = 'set' + attr[0].upper() + attr[1:]
+        resetterName = 'reset' + attr[0].upper() + attr[1:]
+        getter.__name__ = attr
+        setter.__name__ = setterName
+        resetter.__name__ = resetterName
+        return {
+            attr: getter,
+            setterName: setter,
+            resetterName: resetter
+        }
+
     @staticmethod
     def classProperties(kind):
-        ret = []
-        for ctor in reversed(kind.mro()):
-            propArgs = CLASS_PROPERTIES.get(ctor.__qualname__, [])
-            for args in propArgs:
-                ret.append(args)
+        """ Memoized; don't mutate the returned list. """
+        ret = _CLASS_PROPERTIES_CACHE.get(kind)
+        if ret is None:
+            ret = []
+            for ctor in reversed(kind.mro()):
+                propArgs = CLASS_PROPERTIES.get(ctor.__qualname__, [])
+                for args in propArgs:
+                    ret.append(args)
+            _CLASS_PROPERTIES_CACHE[kind] = ret
         return ret
 
     @staticmethod
     def adjustedClassProperties(kind, newEntries):
-        """ Return a copy of the property meta data dict with newEntries added or updated. """
+        """ Return a copy of the property meta data dict with newEntries added or updated.
+        Usually passed on to registerQtProperties(), which invalidates its cache.
+        """
         entries = copy.deepcopy(Item.classProperties(kind))
         for newEntry in newEntries:
             found = False
@@ -90,11 +144,10 @@ class Item(Debug):
     def __init__(self, *args, **kwargs):
         self.id = None
         self._document = None
-        self.propertyListeners = []
-        self.props = []
-        self._propCache = {}
-        propAttrs = self.classProperties(self.__class__)
-        self.addProperties(propAttrs)
+        self.propertyListeners = WeakOrderedSet()
+        self._values = self._schema.newValues()
+        self._layerValues = None # {index: value} while a layer applies
+        self._propCache = {} # Property objects are created on first access
         self._readChunk = {} # forward compat
         self._hasDeinit = False
         self.setProperties(**kwargs)
@@ -105,7 +158,7 @@ class Item(Debug):
         if not 'id' in exclude:
             exclude.append('id')
         props = {}
-        for prop in self.props:
+        for prop in self._propCache.values():
             if not prop.layered and prop.get() != prop.default:
                 props[prop.attr] = prop.get()
         s = Debug.pretty(props, exclude=exclude)
@@ -120,9 +173,8 @@ class Item(Debug):
     def deinit(self):
         """ Virtual. Allways call base implmentation. """
         self._hasDeinit = False
-        for prop in self.props:
+        for prop in self._propCache.values():
             prop.deinit()
-        self.props = []
         self._propCache = {}
 
     def document(self):
@@ -142,27 +194,42 @@ class Item(Debug):
 
     ## Marshalling
     
+    def markChunkDirty(self):
+        """ Call when write() output changed other than through a Property,
+        i.e. keys a subclass writes itself, so Document snapshots and
+        incremental saves write this item again. """
+        document = self if self._isDocument else self._document
+        if document is not None:
+            document.markDirty(self, None)
+
     def write(self, chunk):
         """ virtual """
         # forward compatibility, must be before the rest
         # This call also should be called at the top of subclass impl..
         chunk.update(self._readChunk)
         chunk['id'] = self.id
-        for prop in self.props:
-            chunk[prop.attr] = prop.get(forLayers=[])
-        
+        for meta in self._schema.metas:
+            chunk[meta.attr] = Property.valueOf(self, meta, forLayers=[])
+
     def read(self, chunk, byId):
         """ virtual """
-        self._readChunk = chunk # copy.deepcopy(chunk) # forward compat
         self.id = chunk.get('id', None)
-        for prop in self.props:
-            value = chunk.get(prop.attr, prop.default)
-            if not isinstance(value, prop.type) and value != prop.default:
+        if self._document is None and not self._isDocument:
+            # Not registered yet so nothing to notify, index or mark dirty;
+            # store coerced values straight into _values.
+            self._readChunk = self._schema.reader()(self._values, chunk)
+            return
+        self._readChunk = { k: v for k, v in chunk.items() if not k in self._schema.byAttr } # forward compat
+        for meta in self._schema.metas:
+            value = chunk.get(meta.attr, meta.default)
+            if value == meta.default and self._values[meta.index] is None:
+                continue # already the default
+            if not isinstance(value, meta.type) and value != meta.default:
                 try:
-                    value = prop.type(value)
+                    value = meta.type(value)
                 except TypeError:
                     value = None
-            prop.set(value, notify=False)
+            self.prop(meta.attr).set(value, notify=False)
 
     def clone(self, document):
         """ Virtual """
@@ -172,8 +239,10 @@ class Item(Debug):
         else:
             document.addItem(y)
         y._readChunk = copy.deepcopy(self._readChunk)
-        for prop in self.props:
-            y.prop(prop.attr).set(prop.get(), notify=False)
+        for meta in self._schema.metas:
+            value = Property.valueOf(self, meta)
+            if value != meta.default:
+                y.prop(meta.attr).set(value, notify=False)
         y.setLoggedDate(QDate.currentDate(), notify=False)
         return y
 
@@ -188,12 +257,18 @@ class Item(Debug):
             { 'attr': 'married', 'type': bool, 'default': True, 'update': True },
             { 'attr': 'marriedDate', 'update': True },
         ]
+
+        Only needed for properties added to a single instance at runtime.
+        Properties registered with `registerProperties` get their accessors
+        on the class instead.
         """
         for kwargs in meta:
             if kwargs['attr'] in ['properties', 'opacity']:
                 raise ValueError('`%s` is a reserved method name for Item' % kwargs['attr'])
-            p = Property(self, **kwargs)
+            self._schema = self._schema.extended([kwargs]) # copy on write
+            self._values.extend([None] * (len(self._schema) - len(self._values)))
             attr = kwargs['attr']
+            p = Property(self, self._schema.byAttr[attr])
             setterName = 'set' + attr[0].upper() + attr[1:]
             if not hasattr(self, setterName):
                 setattr(self, setterName, p.set)
@@ -203,7 +278,6 @@ class Item(Debug):
             resetterName = 'reset' + attr[0].upper() + attr[1:]
             if not hasattr(self, resetterName):
                 setattr(self, resetterName, p.reset)
-            self.props.append(p)
             self._propCache[attr] = p
             
     def setProperties(self, **kwargs):
@@ -215,25 +289,57 @@ class Item(Debug):
             if prop:
                 prop.set(v, notify=False)
 
+    def notifyProperty(self, prop):
+        """ Call onProperty(), or hold it until the end of
+        property.coalescedNotifications(). """
+        deferred = Property._deferred
+        if deferred is not None:
+            deferred[(id(self), prop.meta.attr)] = prop
+        else:
+            self.onProperty(prop)
+
     def onProperty(self, prop):
         """ virtual """
         for x in self.propertyListeners:
             x.onItemProperty(prop)
+        document = self._document
+        if document is not None:
+            document.onItemProperty(prop) # routes to its PropertyDispatcher
 
     def addPropertyListener(self, x):
-        if not x in self.propertyListeners:
-            self.propertyListeners.append(x)
+        """ Listeners are weakly referenced and dropped once collected. """
+        self.propertyListeners.add(x)
 
     def removePropertyListener(self, x):
-        if x in self.propertyListeners:
-            self.propertyListeners.remove(x)
+        self.propertyListeners.discard(x)
+
+    def propertyListenerCount(self):
+        """ Fan-out of onProperty(), for profiling. """
+        return len(self.propertyListeners)
+
+    @property
+    def props(self):
+        """ All Property objects in registration order. Allocates any that
+        haven't been accessed yet, so prefer `prop()` in hot paths.
+        """
+        return [self.prop(meta.attr) for meta in self._schema.metas]
 
     def propertyNames(self):
-        return self._propCache.keys()
+        return self._schema.byAttr.keys()
 
     def prop(self, name):
-        if name in self._propCache:
-            return self._propCache[name]
+        prop = self._propCache.get(name)
+        if prop is None:
+            meta = self._schema.byAttr.get(name)
+            if meta is None:
+                return None
+            prop = self._allocateProp(meta)
+        return prop
+
+    def _allocateProp(self, meta):
+        prop = Property(self, meta)
+        self._propCache[meta.attr] = prop
+        return prop
 
 
     ## Tags
@@ -318,20 +424,29 @@ class Item(Debug):
     def onDeregistered(self, document):
         """ virtual """
         self._document = None
+        self._layerValues = None # Document.addItem() re-reads them from the composite
 
     def onActiveLayersChanged(self):
         """ Virtual. Calling base implementation is required. """
+        self.updateLayeredProperties([meta.attr for meta in self._schema.metas if meta.layered])
+
+    def updateLayeredProperties(self, attrs):
+        """ Re-read the layer values for `attrs` and notify the ones that
+        changed. Called from Document.updateActiveLayers for just the attrs
+        that the old or new top layer overrides.
+        """
         changed = []
-        for prop in self.props:
-            if prop.layered:
-                was = prop.get()
-                prop.onActiveLayersChanged()
-                now = prop.get()
-                itemName = prop.item.itemName() and prop.item.itemName() or prop.item.__class__.__name__
-                if now != was:
-                    changed.append(prop)
+        for attr in attrs:
+            meta = self._schema.byAttr.get(attr)
+            if meta is None or not meta.layered:
+                continue
+            prop = self._propCache.get(attr) or self._allocateProp(meta)
+            was = prop.get()
+            prop.onActiveLayersChanged()
+            if prop.get() != was:
+                changed.append(prop)
         for prop in changed:
-            self.onProperty(prop)
+            self.notifyProperty(prop)
 
     def onUpdateAll(self):
         """ Virtual. Calling base implementation is required.
@@ -341,9 +456,9 @@ class Item(Debug):
         number of times at any time.
         """
         self.onActiveLayersChanged()
-        for prop in self.props:
-            if prop.layered:
-                self.onProperty(prop)
+        for meta in self._schema.metas:
+            if meta.layered:
+                self.onProperty(self.prop(meta.attr))
 
     def updateAll(self):
         """ Read-only update of item representation, for example in a gui paint event. """
@@ -359,3 +474,5 @@ class Item(Debug):
         """
         return self._isUpdatingAll
 
+
+Item._compileClassProperties()
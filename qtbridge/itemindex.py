@@ -0,0 +1,166 @@
+from .property import Property
+
+
+class ItemIndex:
+    """ Secondary indexes for Document queries, by class, by tag, and by
+    the value of selected properties.
+
+    Buckets are {id: item} dicts so add/remove/update are O(1). Results are
+    returned in the order items were added, the same as scanning
+    Document.itemRegistry.
+    """
+
+    def __init__(self, attrs=()):
+        self._seq = 0
+        self._order = {} # id -> add sequence
+        self._byClass = {} # class -> {id: item}
+        self._byTag = {} # tag -> {id: item}
+        self._tags = {} # id -> tuple of indexed tags
+        self._byValue = {} # attr -> {value: {id: item}}
+        self._values = {} # attr -> {id: indexed value}
+        self._unhashable = {} # attr -> {id: item}, always scanned
+        self._classesFor = {} # types tuple -> [classes]
+        for attr in attrs:
+            self._byValue[attr] = {}
+            self._values[attr] = {}
+            self._unhashable[attr] = {}
+
+    def __len__(self):
+        return len(self._order)
+
+    def attrs(self):
+        return self._byValue.keys()
+
+    def isIndexed(self, attr):
+        return attr in self._byValue
+
+    ## Maintenance
+
+    def add(self, item):
+        if item.id in self._order:
+            self.remove(item)
+        self._order[item.id] = self._seq
+        self._seq += 1
+        kind = item.__class__
+        if not kind in self._byClass:
+            self._byClass[kind] = {}
+            self._classesFor = {}
+        self._byClass[kind][item.id] = item
+        self._indexTags(item)
+        for attr in self._byValue:
+            self._indexValue(item, attr)
+
+    def remove(self, item):
+        if self._order.pop(item.id, None) is None:
+            return
+        bucket = self._byClass.get(item.__class__)
+        if bucket:
+            bucket.pop(item.id, None)
+        for tag in self._tags.pop(item.id, ()):
+            self._byTag[tag].pop(item.id, None)
+        for attr in self._byValue:
+            self._unindexValue(item, attr)
+
+    def update(self, item, attr):
+        """ Call after `attr` changed on `item`. """
+        if not item.id in self._order:
+            return
+        if attr == 'tags':
+            for tag in self._tags.pop(item.id, ()):
+                self._byTag[tag].pop(item.id, None)
+            self._indexTags(item)
+        if attr in self._byValue:
+            self._unindexValue(item, attr)
+            self._indexValue(item, attr)
+
+    def _indexTags(self, item):
+        meta = item._schema.byAttr.get('tags')
+        tags = meta and Property.valueOf(item, meta)
+        if tags:
+            tags = tuple(tags)
+            self._tags[item.id] = tags
+            for tag in tags:
+                if not tag in self._byTag:
+                    self._byTag[tag] = {}
+                self._byTag[tag][item.id] = item
+
+    def _indexValue(self, item, attr):
+        meta = item._schema.byAttr.get(attr)
+        if meta is None:
+            return
+        value = Property.valueOf(item, meta)
+        try:
+            bucket = self._byValue[attr].get(value)
+        except TypeError:
+            self._unhashable[attr][item.id] = item
+            return
+        if bucket is None:
+            bucket = self._byValue[attr][value] = {}
+        bucket[item.id] = item
+        self._values[attr][item.id] = value
+
+    def _unindexValue(self, item, attr):
+        if item.id in self._unhashable[attr]:
+            del self._unhashable[attr][item.id]
+        elif item.id in self._values[attr]:
+            value = self._values[attr].pop(item.id)
+            bucket = self._byValue[attr][value]
+            bucket.pop(item.id, None)
+            if not bucket:
+                del self._byValue[attr][value]
+
+    ## Queries
+
+    def sorted(self, items):
+        """ Return `items` ({id: item}) in document order. """
+        order = self._order
+        return sorted(items.values(), key=lambda item: order[item.id])
+
+    def ofTypes(self, types):
+        """ Return {id: item} for instances of `types`, including subclasses. """
+        classes = self._classesFor.get(types)
+        if classes is None:
+            classes = [kind for kind in self._byClass if issubclass(kind, types)]
+            self._classesFor[types] = classes
+        if len(classes) == 1:
+            return self._byClass[classes[0]]
+        ret = {}
+        for kind in classes:
+            ret.update(self._byClass[kind])
+        return ret
+
+    def withTags(self, tags, reverseTags):
+        """ Return {id: item} matching Item.hasTags(tags, reverseTags), or
+        None if every item matches.
+        """
+        if not tags and not reverseTags:
+            return None
+        hidden = set()
+        for tag in reverseTags:
+            if not tag in tags:
+                hidden.update(self._byTag.get(tag, ()))
+        if tags:
+            ret = {}
+            for tag in tags:
+                ret.update(self._byTag.get(tag, ()))
+        else:
+            ret = {}
+            for bucket in self._byClass.values():
+                ret.update(bucket)
+        for id in hidden:
+            ret.pop(id, None)
+        return ret
+
+    def withValue(self, attr, value):
+        """ Return [item] whose `attr` == `value`, or None if `value` can't be
+        looked up in the index.
+        """
+        try:
+            bucket = self._byValue[attr].get(value, {})
+        except TypeError:
+            return None
+        ret = list(bucket.values())
+        for item in self._unhashable[attr].values():
+            if item.prop(attr).get() == value:
+                ret.append(item)
+        return ret
@@ -0,0 +1,158 @@
+""" Append-only journal of undo stack edits for crash recovery.
+
+Each pushed, undone, or redone command is written as the list of changes it
+made, by item id and attr rather than object references:
+
+    ('set', layerId, itemId, attr, value)   layerId is None for the item itself,
+                                           itemId is None for the document
+    ('reset', layerId, itemId, attr)
+    ('add', chunk)                         an Item.write() chunk with 'kind'
+    ('remove', itemId)
+
+The journal starts with a save point marker, { 'savePoint': token }, and
+another one is written whenever a background save starts. replayJournal()
+applies the changes after the last marker that matches
+Document.savePoint() of a document loaded from the last save, which brings
+it back to where it was before the crash. A journal written against any
+other document or save is left alone.
+"""
+
+import threading, queue, pickle
+from . import stream
+
+
+class CommandJournal:
+    """ Records are pickled on the calling thread so later edits can't
+    change them, then written and flushed by a daemon thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._queue = queue.Queue()
+        self._file = open(path, 'ab')
+        self._thread = threading.Thread(target=self._run, name='journal', daemon=True)
+        self._thread.start()
+
+    def write(self, changes):
+        if changes:
+            data = pickle.dumps(changes, protocol=pickle.HIGHEST_PROTOCOL)
+            self._queue.put(('write', data))
+
+    def clear(self, savePoint=None):
+        """ Drop everything written so far and start over on top of
+        `savePoint`, i.e. after a save. """
+        self._queue.put(('clear', self._marker(savePoint)))
+
+    def mark(self, savePoint):
+        """ Edits from here on go on top of `savePoint`. """
+        self._queue.put(('write', self._marker(savePoint)))
+
+    def _marker(self, savePoint):
+        return pickle.dumps({ 'savePoint': savePoint }, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def sync(self):
+        """ Block until everything queued is on disk. """
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(('close', None))
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            op, data = self._queue.get()
+            try:
+                if op == 'write':
+                    self._file.write(stream.RECORD_LENGTH.pack(len(data)))
+                    self._file.write(data)
+                    if self._queue.empty():
+                        self._file.flush()
+                elif op == 'clear':
+                    self._file.truncate(0)
+                    self._file.write(stream.RECORD_LENGTH.pack(len(data)))
+                    self._file.write(data)
+                    self._file.flush()
+                elif op == 'close':
+                    self._file.close()
+                    return
+            finally:
+                self._queue.task_done()
+
+
+def readJournal(path):
+    """ Generator of change lists and save point markers. Stops at a
+    record cut short by a crash. """
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield stream.readRecord(f)
+            except (EOFError, pickle.UnpicklingError):
+                return
+
+
+def replayJournal(document, path, kinds=None):
+    """ Apply the changes in the journal at `path` to `document` as one
+    transaction, so signals are coalesced per item and attr. Returns the
+    number of changes applied, 0 if the journal doesn't go with
+    document.savePoint().
+    """
+    start = None
+    for i, record in enumerate(readJournal(path)):
+        if isinstance(record, dict) and record.get('savePoint') == document.savePoint():
+            start = i
+    if start is None:
+        return 0
+    if kinds is None:
+        kinds = stream.itemKinds()
+    count = 0
+    layerSets = {} # layer -> [(itemId, attr, value)], applied in bulk
+    changed = {} # (id(item), attr) -> (item, attr), notified once at the end
+
+    def flushLayerSets():
+        for layer, entries in layerSets.items():
+            layer.setItemPropertiesMany(entries)
+        layerSets.clear()
+
+    with document.transaction('Recover unsaved changes'):
+        for i, changes in enumerate(readJournal(path)):
+            if i <= start or isinstance(changes, dict):
+                continue
+            for change in changes:
+                op = change[0]
+                if op == 'set' and change[1] is not None:
+                    layer = document.itemRegistry.get(change[1])
+                    if layer is not None:
+                        layerSets.setdefault(layer, []).append(change[2:])
+                    count += 1
+                    continue
+                flushLayerSets()
+                if op == 'set' or op == 'reset':
+                    layerId, itemId, attr = change[1:4]
+                    item = document if itemId is None else document.itemRegistry.get(itemId)
+                    if item is None or item.prop(attr) is None:
+                        continue
+                    if layerId is None:
+                        value = change[4] if op == 'set' else None
+                        item.prop(attr).set(value, notify=False, forLayers=[])
+                        changed[(id(item), attr)] = (item, attr)
+                    else:
+                        layer = document.itemRegistry.get(layerId)
+                        if layer is not None:
+                            layer.resetItemPropertiesMany([(itemId, attr)])
+                elif op == 'add':
+                    for item in stream.readItems([change[1]], kinds, byId=document.findById):
+                        old = document.itemRegistry.get(item.id)
+                        if old is not None:
+                            document.removeItem(old)
+                        document.addItem(item)
+                elif op == 'remove':
+                    item = document.itemRegistry.get(change[1])
+                    if item is not None:
+                        document.removeItem(item)
+                count += 1
+        flushLayerSets()
+        for item, attr in changed.values():
+            if item is document or item.document() is document:
+                item.onProperty(item.prop(attr))
+    document.updateActiveLayers() # 'active' may have been replayed without notify
+    return count
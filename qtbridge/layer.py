@@ -1,5 +1,6 @@
 import copy
 from .item import Item
+from .layeroverrides import LayerOverrides
 
 
 class Layer(Item):
@@ -12,9 +13,12 @@ class Layer(Item):
         { 'attr': 'itemProperties', 'type': dict }
     ))
 
+    isLayer = True
+    _revision = 0
+    _overrides = None
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-        self.isLayer = True
         self._document = kwargs.get('document')
         if not 'itemProperties' in kwargs: # avoid shared default value instance
             self.prop('itemProperties').set({}, notify=False)
@@ -46,6 +50,29 @@ class Layer(Item):
 
     ## Item property storage
 
+    def overrides(self):
+        """ Store for itemProperties, rebuilt when the dict is replaced. """
+        data = self.itemProperties()
+        if self._overrides is None or self._overrides.data() is not data:
+            if data is None:
+                data = {}
+                self.prop('itemProperties').set(data, notify=False)
+            self._overrides = LayerOverrides(data)
+        return self._overrides
+
+    def revision(self):
+        """ Bumped every time itemProperties changes. """
+        return self._revision
+
+    def onItemPropertiesChanged(self, itemId=None, propName=None):
+        """ Called after (itemId, propName) changed, or the whole dict was
+        replaced if `itemId` is None.
+        """
+        self._revision += 1
+        document = self.document()
+        if document is not None and document.isDocument:
+            document.onLayerItemPropertiesChanged(self, itemId, propName)
+
     def itemName(self):
         return self.name()
 
@@ -65,31 +92,47 @@ class Layer(Item):
             return None, False
 
     def setItemProperty(self, itemId, propName, value):
-        props = self.itemProperties()
-        if itemId in props:
-            values = props[itemId]
-        else:
-            values = {}
-            props[itemId] = values
-        values[propName] = value
-        self.setItemProperties(props, notify=False) # noop?
-        item = self.document().find(itemId)
+        self.overrides().set(itemId, propName, value)
+        self.onItemPropertiesChanged(itemId, propName)
+
+    def setItemPropertiesMany(self, entries):
+        """ `entries` is an iterable of (itemId, propName, value). """
+        entries = list(entries)
+        self.overrides().setMany(entries)
+        for itemId, propName, value in entries:
+            self.onItemPropertiesChanged(itemId, propName)
+        self._updateItems([(itemId, propName) for itemId, propName, value in entries])
 
     def resetItemProperty(self, prop):
         """ Called from Property.reset. """
-        props = self.itemProperties()
-        itemProps = props.get(prop.item.id)
-        if not itemProps:
+        if self.overrides().reset(prop.item.id, prop.name()):
+            self.onItemPropertiesChanged(prop.item.id, prop.name())
+
+    def resetItemPropertiesMany(self, pairs):
+        """ `pairs` is an iterable of (itemId, propName). """
+        pairs = self.overrides().resetMany(pairs)
+        for itemId, propName in pairs:
+            self.onItemPropertiesChanged(itemId, propName)
+        self._updateItems(pairs)
+
+    def _updateItems(self, pairs):
+        """ Unlike the single-value calls from Property, bulk changes
+        refresh the affected items themselves.
+        """
+        document = self.document()
+        if document is None or not self in document.activeLayers():
             return
-        changed = False
-        if prop.name() in itemProps:
-            del itemProps[prop.name()]
-            changed = True
-        if not itemProps:
-            del props[prop.item.id]
-            changed = True
-        if changed:
-            self.setItemProperties(props, notify=False)
+        attrsById = {}
+        for itemId, propName in pairs:
+            attrsById.setdefault(itemId, set()).add(propName)
+        for itemId, attrs in attrsById.items():
+            item = document.find(itemId)
+            if item is not None:
+                item.updateLayeredProperties(attrs)
+
+    def itemIdsWithProperty(self, propName):
+        """ Ids of the items this layer overrides `propName` for. """
+        return self.overrides().itemIdsFor(propName)
 
     def resetAllItemProperties(self, notify=True, undo=None):
         for itemId, propValues in list(self.itemProperties().items()):
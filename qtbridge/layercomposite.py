@@ -0,0 +1,125 @@
+import collections
+from .property import PropertyMeta
+
+
+class LayerComposite:
+    """ Merged {itemId: {attr: value}} overlay for a stack of active layers.
+    Later layers take precedence, earlier layers fill in what they don't
+    override.
+
+    Composites are cached by the layers and their revisions, so switching
+    back to a recent combination of layers doesn't re-merge anything. The
+    current composite is patched in place as its layers change.
+    """
+
+    def __init__(self, maxCached=8):
+        self.maxCached = maxCached
+        self._cache = collections.OrderedDict() # key -> {itemId: {attr: value}}
+        self._layers = []
+        self._key = ()
+        self._values = {}
+
+    def layers(self):
+        return list(self._layers)
+
+    def values(self):
+        """ Don't mutate the returned dict. """
+        return self._values
+
+    def get(self, itemId, attr):
+        """ Same return signature as Layer.getItemProperty. """
+        values = self._values.get(itemId)
+        if values and attr in values:
+            return values[attr], True
+        return None, False
+
+    @staticmethod
+    def _keyFor(layers):
+        return tuple((layer, layer.revision()) for layer in layers)
+
+    def setLayers(self, layers):
+        """ Return the previous composite for diff(). """
+        was = self._values
+        self._layers = list(layers)
+        self._key = self._keyFor(self._layers)
+        values = self._cache.get(self._key)
+        if values is None:
+            values = self._merge(self._layers)
+            self._cache[self._key] = values
+            while len(self._cache) > self.maxCached:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(self._key)
+        self._values = values
+        return was
+
+    @staticmethod
+    def _applies(layer, attr):
+        """ Property.set() skips layers whose `layerIgnoreAttr` is off. """
+        ignoreAttr = PropertyMeta.layerIgnoreAttrs.get(attr)
+        return ignoreAttr is None or getattr(layer, ignoreAttr)()
+
+    @staticmethod
+    def _merge(layers):
+        ret = {}
+        ignoreAttrs = PropertyMeta.layerIgnoreAttrs
+        for layer in layers:
+            for itemId, values in layer.itemProperties().items():
+                if ignoreAttrs and not ignoreAttrs.keys().isdisjoint(values):
+                    values = {attr: value for attr, value in values.items() if LayerComposite._applies(layer, attr)}
+                    if not values:
+                        continue
+                merged = ret.get(itemId)
+                if merged is None:
+                    ret[itemId] = dict(values)
+                else:
+                    merged.update(values)
+        return ret
+
+    def onLayerChanged(self, layer, itemId=None, attr=None):
+        """ Called after `layer` changed (itemId, attr), or all of its values
+        if `itemId` is None. Returns the previous composite if it had to be
+        rebuilt, otherwise None.
+        """
+        for key in [key for key in self._cache if key != self._key and any(x is layer for x, revision in key)]:
+            del self._cache[key] # stale revision
+        if not any(x is layer for x in self._layers):
+            return None
+        self._cache.pop(self._key, None)
+        if itemId is None:
+            was = self._values
+            self.setLayers(self._layers)
+            return was
+        values = self._values.get(itemId)
+        for x in reversed(self._layers):
+            if not self._applies(x, attr):
+                continue
+            value, ok = x.getItemProperty(itemId, attr)
+            if ok:
+                if values is None:
+                    values = self._values[itemId] = {}
+                values[attr] = value
+                break
+        else:
+            if values and attr in values:
+                del values[attr]
+                if not values:
+                    del self._values[itemId]
+        self._key = self._keyFor(self._layers)
+        self._cache[self._key] = self._values
+        return None
+
+    @staticmethod
+    def diff(was, now):
+        """ Return {itemId: {attr}} whose value differs between two composites. """
+        ret = {}
+        missing = object()
+        for itemId in set(was) | set(now):
+            a = was.get(itemId) or {}
+            b = now.get(itemId) or {}
+            if a is b or a == b:
+                continue
+            attrs = {attr for attr in set(a) | set(b) if a.get(attr, missing) != b.get(attr, missing)}
+            if attrs:
+                ret[itemId] = attrs
+        return ret
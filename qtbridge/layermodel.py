@@ -1,6 +1,5 @@
 from .pyqt import Qt, QAbstractListModel, QModelIndex, pyqtSlot, qmlRegisterType, QVariant, QMessageBox, QApplication
 from . import util, commands
-from .property import Property
 from .layer import Layer
 from .modelhelper import ModelHelper
 
@@ -20,24 +19,67 @@ class LayerModel(QAbstractListModel, ModelHelper):
     def __init__(self, parent=None):
         super().__init__(parent)
         self._layers = []
-        self._reorderingLayers = False
         self.initModelHelper()
 
     def set(self, attr, value):
         if attr == 'document':
             if self._document:
-                self._document.layerAdded[Layer].disconnect(self.onLayerAdded)
-                self._document.layerChanged[Property].disconnect(self.onLayerChanged)
-                self._document.layerRemoved[Layer].disconnect(self.onLayerRemoved)
+                self._document.itemsAdded[list].disconnect(self.onItemsAdded)
+                self._document.propertiesChanged[list].disconnect(self.onPropertiesChanged)
+                self._document.itemsRemoved[list].disconnect(self.onItemsRemoved)
                 self._layers = []
             if value:
-                value.layerAdded[Layer].connect(self.onLayerAdded)
-                value.layerChanged[Property].connect(self.onLayerChanged)
-                value.layerRemoved[Layer].connect(self.onLayerRemoved)
+                value.itemsAdded[list].connect(self.onItemsAdded)
+                value.propertiesChanged[list].connect(self.onPropertiesChanged)
+                value.itemsRemoved[list].connect(self.onItemsRemoved)
                 self._layers = value.layers()
             self.modelReset.emit()
         super().set(attr, value)
 
+    def onItemsAdded(self, items):
+        layers = [item for item in items if item.isLayer]
+        if len(layers) == 1:
+            self.onLayerAdded(layers[0])
+        elif layers:
+            self._layers = self._document.layers()
+            self.modelReset.emit()
+
+    def onItemsRemoved(self, items):
+        for item in items:
+            if item.isLayer and item in self._layers:
+                self.onLayerRemoved(item)
+
+    @util.blocked
+    def onPropertiesChanged(self, props):
+        """ One dataChanged per row, and at most one reset for reordering. """
+        roles = {}
+        reorder = False
+        for prop in props:
+            if not prop.item.isLayer:
+                continue
+            if prop.name() == 'order':
+                reorder = True
+                continue
+            role = self.roleFor(prop.name())
+            if role is not None and prop.item in self._layers:
+                roles.setdefault(prop.item, []).append(role)
+        if reorder and self._layers != self._document.layers():
+            self._layers = self._document.layers()
+            self.modelReset.emit()
+        for layer, layerRoles in roles.items():
+            row = self._layers.index(layer)
+            self.dataChanged.emit(self.index(row, 0),
+                                  self.index(row, 0), layerRoles)
+
+    def roleFor(self, attr):
+        return {
+            'id': self.IdRole,
+            'active': self.ActiveRole,
+            'name': self.NameRole,
+            'description': self.DescriptionRole,
+            'tags': self.TagsRole
+        }.get(attr)
+
     @util.blocked
     def onLayerAdded(self, layer):
         # expects it to already have `order` set
@@ -45,29 +87,6 @@ class LayerModel(QAbstractListModel, ModelHelper):
         self._layers = self.document.layers()
         self.endInsertRows()
         
-    @util.blocked
-    def onLayerChanged(self, prop):
-        role = None
-        if prop.name() == 'id':
-            role = self.IdRole
-        elif prop.name() == 'active':
-            role = self.ActiveRole
-        elif prop.name() == 'name':
-            role = self.NameRole
-        elif prop.name() == 'description':
-            role = self.DescriptionRole
-        elif prop.name() == 'tags':
-            role = self.TagsRole
-        elif prop.name() == 'order':
-            if self._reorderingLayers:
-                return
-            self._layers = self._document.layers()
-            self.modelReset.emit()
-        if role is not None:
-            row = self._layers.index(prop.item)
-            self.dataChanged.emit(self.index(row, 0),
-                                  self.index(row, 0), [role])
-
     @util.blocked
     def onLayerRemoved(self, layer):
         row = self._layers.index(layer)
@@ -127,11 +146,9 @@ class LayerModel(QAbstractListModel, ModelHelper):
 
     @pyqtSlot(int, int)
     def moveLayer(self, oldRow, newRow):
-        self._reorderingLayers = True
         self._layers.insert(newRow, self._layers.pop(oldRow))
         commands.setLayerOrder(self._document, self._layers)
         self.modelReset.emit()
-        self._reorderingLayers = False
         
     ## Qt Virtuals
 
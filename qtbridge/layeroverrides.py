@@ -0,0 +1,79 @@
+class LayerOverrides:
+    """ (itemId, attr) -> value store for one Layer.
+
+    Wraps the layer's nested {itemId: {attr: value}} itemProperties dict
+    in place, so write() still gets the same dict with no copy. Adds a
+    reverse index of which items override each attr.
+    """
+
+    def __init__(self, data):
+        self._data = data
+        self._byAttr = {} # attr -> {itemId}
+        for itemId, values in data.items():
+            for attr in values:
+                self._index(itemId, attr)
+
+    def data(self):
+        """ The wrapped itemProperties dict. """
+        return self._data
+
+    def __len__(self):
+        return sum(len(values) for values in self._data.values())
+
+    def _index(self, itemId, attr):
+        itemIds = self._byAttr.get(attr)
+        if itemIds is None:
+            itemIds = self._byAttr[attr] = set()
+        itemIds.add(itemId)
+
+    def get(self, itemId, attr):
+        """ Same return signature as Layer.getItemProperty. """
+        values = self._data.get(itemId)
+        if values and attr in values:
+            return values[attr], True
+        return None, False
+
+    def set(self, itemId, attr, value):
+        values = self._data.get(itemId)
+        if values is None:
+            values = self._data[itemId] = {}
+        values[attr] = value
+        self._index(itemId, attr)
+
+    def reset(self, itemId, attr):
+        """ Return True if there was a value to remove. """
+        values = self._data.get(itemId)
+        if not values or not attr in values:
+            return False
+        del values[attr]
+        if not values:
+            del self._data[itemId]
+        itemIds = self._byAttr[attr]
+        itemIds.discard(itemId)
+        if not itemIds:
+            del self._byAttr[attr]
+        return True
+
+    def setMany(self, entries):
+        """ `entries` is an iterable of (itemId, attr, value). """
+        for itemId, attr, value in entries:
+            self.set(itemId, attr, value)
+
+    def resetMany(self, pairs):
+        """ `pairs` is an iterable of (itemId, attr). Return the ones removed. """
+        return [(itemId, attr) for itemId, attr in pairs if self.reset(itemId, attr)]
+
+    def valuesFor(self, itemIds):
+        """ {itemId: {attr: value}} copies for those of the set `itemIds`
+        that have overrides. Costs the smaller of the two sizes. """
+        data = self._data
+        if len(itemIds) > len(data):
+            return { itemId: dict(values) for itemId, values in data.items() if itemId in itemIds }
+        return { itemId: dict(data[itemId]) for itemId in itemIds if itemId in data }
+
+    def itemIdsFor(self, attr):
+        """ Ids of items that override `attr`. Don't mutate. """
+        return self._byAttr.get(attr, frozenset())
+
+    def attrs(self):
+        return self._byAttr.keys()
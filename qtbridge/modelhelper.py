@@ -25,6 +25,7 @@ class ModelHelper(QObjectHelper):
         self._addMode = False
         self._dirty = False
         self._items = []
+        self._subscribedDocuments = []
         self._document = None
         self._resetter = False
         self.itemsChanged.connect(self.onItemsChanged)
@@ -37,6 +38,27 @@ class ModelHelper(QObjectHelper):
         self.initQObjectHelper(storage=storage)
         self._ModelHelperInitializing = False
 
+    def _subscribeItems(self):
+        """ One dispatcher subscription per document for the whole
+        selection; a listener only on items that aren't in a document. """
+        itemIds = {}
+        for item in self._items:
+            document = item.document()
+            if document is None:
+                item.addPropertyListener(self)
+            else:
+                itemIds.setdefault(document, set()).add(item.id)
+        for document, ids in itemIds.items():
+            document.dispatcher().subscribeItems(self, ids)
+        self._subscribedDocuments = list(itemIds)
+
+    def _unsubscribeItems(self):
+        for item in self._items:
+            item.removePropertyListener(self)
+        for document in self._subscribedDocuments:
+            document.dispatcher().unsubscribeItems(self)
+        self._subscribedDocuments = []
+
     def onItemProperty(self, prop):
         """ Properties come upstream through here upon undo. """
         # Now that one of the many values for this property has changed,
@@ -52,6 +74,11 @@ class ModelHelper(QObjectHelper):
         if prop.name() == 'hideNames':
             self.refreshAllProperties()
 
+    def onDocumentPropertiesChanged(self, props):
+        """ Document already coalesced these per item and attr. """
+        for prop in props:
+            self.onDocumentProperty(prop)
+
     def onItemsChanged(self, items):
         """ For stack trace in test. """
         self.refreshAllProperties()
@@ -127,23 +154,21 @@ class ModelHelper(QObjectHelper):
             self.refreshProperty('dirty')
         if attr == 'items':
             if self._items:
-                for item in self._items:
-                    item.removePropertyListener(self)
+                self._unsubscribeItems()
                 self._items = []
             if value not in (None, [None]):
                 if not isinstance(value, list):
                     value = [value]
                 self._items = value
-                for item in self._items:
-                    item.addPropertyListener(self)
+                self._subscribeItems()
             self.refreshProperty('items')
             return
         elif attr == 'document':
             if self._document:
-                self._document.propertyChanged[objects.Property].disconnect(self.onDocumentProperty)
+                self._document.propertiesChanged[list].disconnect(self.onDocumentPropertiesChanged)
             self._document = value
             if self._document:
-                self._document.propertyChanged[objects.Property].connect(self.onDocumentProperty)
+                self._document.propertiesChanged[list].connect(self.onDocumentPropertiesChanged)
             self.refreshProperty('document')
             return
         elif attr == 'blockNotify':
@@ -181,18 +206,24 @@ class ModelHelper(QObjectHelper):
             id = commands.nextId()
         notify = not self._blockNotify
         foundItemProp = False
+        props = []
         for item in self._items:
             # if the item has not been set yet then leave it alone
             prop = item.prop(attr)
             if prop is not None:
                 foundItemProp = True
                 y = prop.get()
-                if y != x:
-                    prop.set(x, notify=notify, undo=id)
+                if y != prop.convert(x):
+                    props.append(prop)
                     # if x == prop.default:
                     #     prop.reset(notify=notify, undo=id)
                     # else:
                     #     prop.set(x, notify=notify, undo=id)
+        if props and id:
+            # one command for all items rather than one merged per item
+            commands.stack().push(commands.SetItemProperties(props, x, id=id))
+        for prop in props:
+            prop.set(x, notify=notify)
         if not foundItemProp:
             super().set(attr, value)
 
@@ -0,0 +1,123 @@
+""" Read stream files by decoding item records in a process pool.
+
+Workers unpickle and type-coerce records into the same compact value
+lists that Item keeps in `_values`, so the main thread only has to
+construct items and add them in bulk. Kinds that reimplement Item.read()
+get their raw chunk back and are read on the main thread as usual.
+"""
+
+import pickle, concurrent.futures
+from .item import Item
+from .property import compileCoercer
+from . import stream
+
+
+def schemaTable(kinds):
+    """ {kind name: [(attr, type, default, strip, copyDefault)] in _values order}, or
+    None for kinds that reimplement read(). Must be picklable.
+    """
+    ret = {}
+    for name, kind in kinds.items():
+        if kind.read is not Item.read or not hasattr(kind, '_schema'):
+            ret[name] = None
+        else:
+            ret[name] = [(meta.attr, meta.type, meta.default, meta.strip, meta.copyDefault)
+                         for meta in kind._schema.metas]
+    return ret
+
+
+def decodeRecords(blob, table):
+    """ Runs in a worker. Return [(kind name, id, values, extras, chunk)]
+    for the length-prefixed records in `blob`. `chunk` is only set for
+    kinds that reimplement read().
+    """
+    readers = {}
+    for kindName, metas in table.items():
+        if metas is not None:
+            readers[kindName] = [(attr, compileCoercer(kind, default, strip, copyDefault))
+                                 for attr, kind, default, strip, copyDefault in metas]
+    ret = []
+    view = memoryview(blob)
+    offset = 0
+    while offset < len(blob):
+        length, = stream.RECORD_LENGTH.unpack_from(blob, offset)
+        offset += stream.RECORD_LENGTH.size
+        chunk = pickle.loads(view[offset:offset + length])
+        offset += length
+        kindName = chunk.pop('kind', None)
+        reader = readers.get(kindName)
+        if reader is None:
+            ret.append((kindName, chunk.get('id'), None, None, chunk))
+            continue
+        values = [coerce(chunk.pop(attr)) if attr in chunk else None for attr, coerce in reader]
+        ret.append((kindName, chunk.pop('id', None), values, chunk, None))
+    return ret
+
+
+def _rawBatches(f, count, batchSize):
+    """ Split the next `count` records into blobs without unpickling them. """
+    while count > 0:
+        n = min(batchSize, count)
+        parts = []
+        for i in range(n):
+            header = f.read(stream.RECORD_LENGTH.size)
+            if len(header) < stream.RECORD_LENGTH.size:
+                raise EOFError('Unexpected end of stream')
+            length, = stream.RECORD_LENGTH.unpack(header)
+            parts.append(header)
+            parts.append(f.read(length))
+        count -= n
+        yield b''.join(parts)
+
+
+def instantiate(kinds, decoded, byId=None):
+    """ Main thread. Build unregistered items from decodeRecords() output. """
+    items = []
+    for kindName, id, values, extras, chunk in decoded:
+        kind = kinds.get(kindName)
+        if kind is None:
+            raise ValueError('Unknown item kind: %s' % kindName)
+        item = kind()
+        if values is None:
+            item.read(chunk, byId)
+        else:
+            item.id = id
+            item._values = values
+            item._readChunk = extras # unknown attrs only; write() replaces the rest
+        items.append(item)
+    return items
+
+
+def readDocumentParallel(document, path, kinds=None, executor=None, batchSize=5000, progress=None):
+    """ Like stream.readDocument(), with decoding spread over `executor`
+    (a ProcessPoolExecutor by default).
+    """
+    if kinds is None:
+        kinds = stream.itemKinds()
+    table = schemaTable(kinds)
+    ownExecutor = executor is None
+    if ownExecutor:
+        executor = concurrent.futures.ProcessPoolExecutor()
+    try:
+        with stream.openFile(path) as f:
+            header = stream.readRecord(f)
+            if header.get('version', 0) > stream.VERSION:
+                raise ValueError('Unsupported stream version: %s' % header.get('version'))
+            document._savePoint = header.get('savePoint')
+            document.read(stream.readRecord(f), document.findById)
+            total = header['count']
+            futures = [executor.submit(decodeRecords, blob, table)
+                       for blob in _rawBatches(f, total, batchSize)]
+            done = 0
+            for future in futures: # in file order
+                items = instantiate(kinds, future.result(), document.findById)
+                document.addItems(*items)
+                done += len(items)
+                if progress:
+                    progress(done, total)
+            for delta in stream.iterRecords(f):
+                stream.applyDelta(document, delta, kinds)
+    finally:
+        if ownExecutor:
+            executor.shutdown()
+    document.clearDirty()
@@ -1,11 +1,180 @@
-import copy
+import copy, contextlib
 from . import debug, commands
 
 
+class PropertyMeta:
+    """ Immutable metadata for one registered property, shared by every
+    instance of the class that registered it. """
+
+    __slots__ = ('kwargs', 'index', 'attr', 'type', 'default', 'copyDefault',
+                 'layered', 'notify', 'onset', 'strip', 'isDynamic', 'layerIgnoreAttr')
+
+    layerIgnoreAttrs = {} # {attr: layerIgnoreAttr} across all classes, for LayerComposite
+
+    def __init__(self, index, **kwargs):
+        self.kwargs = kwargs
+        self.index = index # slot in Item._values
+        self.attr = kwargs['attr']
+        self.onset = kwargs.get('onset', None)
+        self.default = kwargs.get('default', None)
+        self.copyDefault = isinstance(self.default, (list, dict))
+        self.isDynamic = kwargs.get('dynamic', False)
+        self.strip = kwargs.get('strip', False)
+        self.layered = kwargs.get('layered', False)
+        self.notify = kwargs.get('notify', True)
+        self.layerIgnoreAttr = kwargs.get('layerIgnoreAttr')
+        if self.layerIgnoreAttr:
+            PropertyMeta.layerIgnoreAttrs[self.attr] = self.layerIgnoreAttr
+        if 'type' in kwargs:
+            self.type = kwargs['type']
+        else:
+            self.type = 'default' in kwargs and type(self.default) or str
+            kwargs['type'] = self.type
+
+    def replaced(self, **kwargs):
+        """ Return a copy with some attributes changed. """
+        x = dict(self.kwargs)
+        x.update(kwargs)
+        return PropertyMeta(self.index, **x)
+
+
+def compileCoercer(kind, default, strip, copyDefault):
+    """ Return a function that turns a value read from a file into what
+    Property.set would store, without the equality checks. Mutable
+    defaults are left as None so each item doesn't get its own copy.
+    """
+    if kind is type(None):
+        return lambda value: None
+    def coerce(value):
+        if value is None:
+            return None
+        if copyDefault:
+            if value == default:
+                return None
+        elif type(value) is kind:
+            return value.strip() if strip else value
+        try:
+            value = kind(value)
+        except TypeError:
+            return None
+        return value.strip() if strip else value
+    return coerce
+
+
+@contextlib.contextmanager
+def coalescedNotifications():
+    """ Hold Item.onProperty() calls made inside and make them once per
+    (item, attr) at the end. Documents then queue them into a single
+    propertiesChanged. Nests.
+    """
+    began = beginCoalescing()
+    try:
+        yield
+    finally:
+        if began:
+            endCoalescing()
+
+
+def beginCoalescing():
+    """ Start holding notifications, for when the end isn't in the same
+    scope, see UndoStack. Returns False if they already are being held.
+    """
+    if Property._deferred is not None:
+        return False
+    Property._deferred = {}
+    return True
+
+
+def endCoalescing():
+    deferred = Property._deferred
+    Property._deferred = None
+    for prop in (deferred or {}).values():
+        if prop.item is not None:
+            prop.item.onProperty(prop)
+
+
+class PropertySchema:
+    """ Ordered property metadata for an Item class. Each item only stores a
+    value list indexed by `PropertyMeta.index`. """
+
+    __slots__ = ('metas', 'byAttr', '_reader')
+
+    def __init__(self, entries=()):
+        self.metas = []
+        self.byAttr = {}
+        self._reader = None
+        for kwargs in entries:
+            self._append(kwargs)
+
+    def __len__(self):
+        return len(self.metas)
+
+    def __iter__(self):
+        return iter(self.metas)
+
+    def _append(self, kwargs):
+        attr = kwargs['attr']
+        if attr in self.byAttr: # re-registered by a subclass
+            meta = PropertyMeta(self.byAttr[attr].index, **kwargs)
+            self.metas[meta.index] = meta
+        else:
+            meta = PropertyMeta(len(self.metas), **kwargs)
+            self.metas.append(meta)
+        self.byAttr[attr] = meta
+        self._reader = None
+        return meta
+
+    def extended(self, entries):
+        """ Return a copy with `entries` appended, for per-instance properties. """
+        ret = PropertySchema()
+        ret.metas = list(self.metas)
+        ret.byAttr = dict(self.byAttr)
+        for kwargs in entries:
+            ret._append(kwargs)
+        return ret
+
+    def newValues(self):
+        return [None] * len(self.metas)
+
+    def reader(self):
+        """ Compiled Item.read() for unregistered items: returns a function
+        that fills `values` from `chunk` and returns the unknown keys.
+        """
+        if self._reader is None:
+            entries = [(meta.index, meta.attr, compileCoercer(meta.type, meta.default, meta.strip, meta.copyDefault))
+                       for meta in self.metas]
+            byAttr = self.byAttr
+            def read(values, chunk):
+                for index, attr, coerce in entries:
+                    if attr in chunk:
+                        values[index] = coerce(chunk[attr])
+                    else:
+                        values[index] = None
+                return { k: v for k, v in chunk.items() if not k in byAttr and k != 'id' }
+            self._reader = read
+        return self._reader
+
+
 class Property(debug.Debug):
-    """ Track changes and automatically write to file. """
+    """ Track changes and automatically write to file.
+
+    A light handle onto the value stored in `item._values`. Layer values are
+    cached sparsely in `item._layerValues` while a layer applies.
+    """
+
+    __slots__ = ('item', 'meta', '_id', '_isResetting', '_saying', '_blocked', '_debug')
 
     _nextId = 0
+    _deferred = None # {(id(item), attr): prop} inside coalescedNotifications()
+
+    @property
+    def DEBUG(self):
+        """ Slotted, so Debug.setDebug() is stored in `_debug`. """
+        return getattr(self, '_debug', debug.Debug.DEBUG)
+
+    @DEBUG.setter
+    def DEBUG(self, on):
+        self._debug = on
 
     @staticmethod
     def sortBy(stuff, attr):
@@ -23,32 +192,38 @@ class Property(debug.Debug):
                 return default
         return sorted(stuff, key=getKey)
 
-    def __init__(self, item, **kwargs):
-        super().__init__()
-        self._kwargs = kwargs
+    @staticmethod
+    def valueOf(item, meta, forLayers=None):
+        """ Property.get() without allocating a Property. """
+        if meta.layered:
+            if forLayers: # non-cached query
+                # last layer takes precidence, same as Document.layerComposite()
+                for layer in reversed(forLayers):
+                    if meta.layerIgnoreAttr and not getattr(layer, meta.layerIgnoreAttr)():
+                        continue
+                    value, ok = layer.getItemProperty(item.id, meta.attr) # because properties don't have reliable id's. nuts...
+                    if ok:
+                        return value
+                return None
+            # forLayers == [] means force no layer in Item.read()
+            elif item._layerValues and forLayers != [] and meta.index in item._layerValues:
+                return item._layerValues[meta.index]
+        value = item._values[meta.index]
+        if value is not None:
+            return value
+        elif meta.copyDefault: # avoid shared default value instance
+            value = copy.deepcopy(meta.default)
+            item._values[meta.index] = value
+            return value
+        return meta.default
+
+    def __init__(self, item, meta):
         self._id = Property._nextId
         Property._nextId = Property._nextId + 1
         self.item = item
-        self.isDynamic = False
-        self.attr = kwargs['attr']
-        self.onset = kwargs.get('onset', None)
-        self.default = kwargs.get('default', None)
-        if isinstance(self.default, (list, dict)):
-            self.default = copy.deepcopy(self.default)
-        self.isDynamic = kwargs.get('dynamic', False)
-        self._value = None
-        self._currentLayerValue = None
-        self._usingLayer = False # updated on activeLayersChanged
-        self._activeLayers = []
+        self.meta = meta
         self._isResetting = False
-        self.strip = kwargs.get('strip', False)
-        self.layered = kwargs.get('layered', False)
-        self.notify = kwargs.get('notify', True)
-        if 'type' in kwargs:
-            self.type = kwargs['type']
-        else:
-            self.type = 'default' in kwargs and type(self.default) or str
-            kwargs['type'] = self.type
+        self._saying = False
 
     def __repr__(self):
         s = str(self.get())
@@ -56,24 +231,64 @@ class Property(debug.Debug):
             s = ': ' + s
         return '<Property[%i, %s]%s>' % (self.id(), self.name(), s)
 
+    @property
+    def attr(self):
+        return self.meta.attr
+
+    @property
+    def type(self):
+        return self.meta.type
+
+    @property
+    def default(self):
+        return self.meta.default
+
+    @property
+    def layered(self):
+        return self.meta.layered
+
+    @property
+    def notify(self):
+        return self.meta.notify
+
+    @property
+    def onset(self):
+        return self.meta.onset
+
+    @property
+    def strip(self):
+        return self.meta.strip
+
+    @property
+    def isDynamic(self):
+        return self.meta.isDynamic
+
+    @property
+    def _activeLayers(self):
+        if self.meta.layered:
+            document = self.item.document()
+            if document is not None:
+                return document.activeLayers()
+        return ()
+
     def name(self):
-        return self.attr
+        return self.meta.attr
 
     def kwargs(self):
-        return self._kwargs
+        return self.meta.kwargs
 
     def deinit(self):
         """ For circular refs. """
         self.item = None
 
     def setAttr(self, attr):
-        self.attr = attr
+        self.meta = self.meta.replaced(attr=attr)
 
     def setLayered(self, on):
-        self.layered = on
+        self.meta = self.meta.replaced(layered=on)
 
     def isset(self):
-        return self.get() != self.default
+        return self.get() != self.meta.default
 
     def id(self):
         return self._id
@@ -82,46 +297,55 @@ class Property(debug.Debug):
         if self.item:
             return self.item.document()
 
+    def _setLayerValue(self, value):
+        item = self.item
+        if item._layerValues is None:
+            item._layerValues = {}
+        item._layerValues[self.meta.index] = value
+
+    def _clearLayerValue(self):
+        layerValues = self.item._layerValues
+        if layerValues and self.meta.index in layerValues:
+            del layerValues[self.meta.index]
+
+    def _onStored(self):
+        """ Keep document-level bookkeeping current, even for notify=False. """
+        item = self.item
+        document = item if item._isDocument else item._document
+        if document is not None:
+            document.markDirty(item, self.meta.attr)
+            if document._itemIndex is not None:
+                document._itemIndex.update(item, self.meta.attr)
+        if item.isLayer and self.meta.attr == 'itemProperties':
+            item.onItemPropertiesChanged()
+
     def onActiveLayersChanged(self):
         if self.layered:
             # update caches
-            self._activeLayers = self.document().activeLayers()
-            if self.document().hideLayers():
-                self._currentLayerValue = None
-                self._usingLayer = False
-            elif self._activeLayers:
-                ok = False
-                # last active layer takes precidence
-                value, ok = self._activeLayers[-1].getItemProperty(self.item.id, self.name()) # because properties don't have reliable id's. nuts...
+            document = self.document()
+            if document.hideLayers():
+                self._clearLayerValue()
+            else:
+                # merged active layers, last one takes precidence
+                value, ok = document.layerComposite().get(self.item.id, self.name())
                 if ok:
-                    self._currentLayerValue = value
-                    self._usingLayer = True
+                    self._setLayerValue(value)
                 else:
-                    self._currentLayerValue = None
-                    self._usingLayer = False
-            else:
-                self._currentLayerValue = None
-                self._usingLayer = False
+                    self._clearLayerValue()
 
     def get(self, forLayers=None):
         """ Cache value(s). """
-        ret = None
-        if self.layered and forLayers: # non-cached query
-            # last active layer takes precidence
-            value, ok = forLayers[-1].getItemProperty(self.item.id, self.name()) # because properties don't have reliable id's. nuts...
-            if ok:
-                ret = value
-        # forLayers == [] means force no layer in Item.read()
-        elif self.layered and self._usingLayer and forLayers != []:
-            ret = self._currentLayerValue
-        else:
-            if self._value is not None:
-                ret = self._value
-            elif self.default is not None:
-                ret = self.default
-            else:
-                ret = None
-        return ret
+        return Property.valueOf(self.item, self.meta, forLayers)
+
+    def convert(self, x):
+        """ The value set(x) stores. """
+        meta = self.meta
+        if x is None or meta.type is type(None):
+            return None
+        y = meta.type(x)
+        if meta.strip:
+            y = y.strip()
+        return y
 
     def set(self, x, notify=True, undo=None, forLayers=None, force=False):
         """ Return True if value was changed, otherwise False.
@@ -129,46 +353,42 @@ class Property(debug.Debug):
             forLayers == []: non-layer value
             force = True for commands.SetItemProperty so notifications are sent
         """
-        if x is None:
-            y = None
-        else:
-            if self.type is type(None):
-                y = None
-            else:
-                y = self.type(x)
-        if self.strip and y is not None:
-            y = y.strip()
+        meta = self.meta
+        y = self.convert(x)
         currentValue = self.get()
         if force or y != currentValue:
+            activeLayers = self._activeLayers
             if undo:
                 # do this before setting the value so `was` can be extracted from layers
                 if undo is True:
                     undo = commands.nextId()
-                cmd = commands.SetItemProperty(self, y, layers=self._activeLayers, id=undo)
+                cmd = commands.SetItemProperty(self, y, layers=activeLayers, id=undo)
                 commands.stack().push(cmd)
             if forLayers is None:
-                layers = self._activeLayers
+                layers = activeLayers
             else:
                 layers = forLayers
-            if layers and self._kwargs.get('layerIgnoreAttr'):
-                layerIgnoreAttr = self._kwargs.get('layerIgnoreAttr')
-                layers = [layer for layer in layers if getattr(layer, layerIgnoreAttr)()]
-            if self.layered and layers:
+            if layers and meta.layerIgnoreAttr:
+                layers = [layer for layer in layers if getattr(layer, meta.layerIgnoreAttr)()]
+            if meta.layered and layers:
                 appliesRightNow = False
                 for layer in layers:
-                    layer.setItemProperty(self.item.id, self.attr, y)
-                    if layer in self._activeLayers:
+                    layer.setItemProperty(self.item.id, meta.attr, y)
+                    if layer in activeLayers:
                         appliesRightNow = True
                 if appliesRightNow:
-                    self._usingLayer = True
-                    self._currentLayerValue = y
+                    # a higher active layer may still override the ones written to
+                    self.onActiveLayersChanged()
+                    appliesRightNow = self.get() == y
             else:
-                self._value = y
+                self.item._values[meta.index] = y
                 appliesRightNow = True
-            if self.notify and notify and appliesRightNow:
-                self.item.onProperty(self)
-                if self.onset and hasattr(self.item, self.onset):
-                    getattr(self.item, self.onset)()
+            if appliesRightNow:
+                self._onStored()
+            if meta.notify and notify and appliesRightNow:
+                self.item.notifyProperty(self)
+                if meta.onset and hasattr(self.item, meta.onset):
+                    getattr(self.item, meta.onset)()
             return True
         else:
             return False
@@ -177,27 +397,29 @@ class Property(debug.Debug):
         if not self.isset():
             return
         self._isResetting = True
+        activeLayers = self._activeLayers
         if undo:
             if undo is True:
                 undo = commands.nextId()
-            cmd = commands.ResetItemProperty(self, layers=self._activeLayers, id=undo)
+            cmd = commands.ResetItemProperty(self, layers=activeLayers, id=undo)
             commands.stack().push(cmd)
-        if self._usingLayer:
-            for layer in self._activeLayers:
+        if self.isUsingLayer():
+            for layer in activeLayers:
                 layer.resetItemProperty(self)
-            self._currentLayerValue = None
-            self._usingLayer = False
+            self._clearLayerValue()
         else:
-            self._value = None
-        if self.notify and notify:
-            self.item.onProperty(self)
-            if self.onset and hasattr(self.item, self.onset):
-                getattr(self.item, self.onset)()
+            self.item._values[self.meta.index] = None
+        self._onStored()
+        if self.meta.notify and notify:
+            self.item.notifyProperty(self)
+            if self.meta.onset and hasattr(self.item, self.meta.onset):
+                getattr(self.item, self.meta.onset)()
         self._isResetting = False
         
     def isUsingLayer(self):
         """ Return True if value is currently being pulled from the layer versus this props's internal value. """
-        return self._usingLayer
+        layerValues = self.item._layerValues
+        return bool(layerValues) and self.meta.index in layerValues
 
     def isResetting(self):
         """ Item.onProperty can respond differently in some cases, e.g. to animate when resetting itemPos. """
@@ -4,6 +4,7 @@ from .. import Debug, objects
 
 
 CLASS_PROPERTIES = { }
+_CLASS_PROPERTIES_CACHE = { } # class -> (entries, {attr: entry})
 
 
 class QObjectHelper(Debug):
@@ -88,16 +89,30 @@ class QObjectHelper(Debug):
         global CLASS_PROPERTIES
         __qualname__ = classAttrs['__qualname__']
         CLASS_PROPERTIES[__qualname__] = attrEntries
+        _CLASS_PROPERTIES_CACHE.clear()
 
     @staticmethod
-    def classProperties(kind):
-        ret = []
-        for ctor in reversed(kind.mro()):
-            classAttrs = CLASS_PROPERTIES.get(ctor.__qualname__, [])
-            for kwargs in classAttrs:
-                ret.append(kwargs)
+    def _compiledClassProperties(kind):
+        ret = _CLASS_PROPERTIES_CACHE.get(kind)
+        if ret is None:
+            entries = []
+            for ctor in reversed(kind.mro()):
+                classAttrs = CLASS_PROPERTIES.get(ctor.__qualname__, [])
+                for kwargs in classAttrs:
+                    entries.append(kwargs)
+            # first match wins, same as the old linear scan
+            byAttr = {}
+            for kwargs in entries:
+                byAttr.setdefault(kwargs['attr'], kwargs)
+            ret = (entries, byAttr)
+            _CLASS_PROPERTIES_CACHE[kind] = ret
         return ret
 
+    @staticmethod
+    def classProperties(kind):
+        """ Memoized; don't mutate the returned list. """
+        return QObjectHelper._compiledClassProperties(kind)[0]
+
     def registerQmlMethods(entries):
         """ Forwards calls to QObject class methods to their qml-javascript correlates. """
         classAttrs = inspect.currentframe().f_back.f_locals
@@ -184,10 +199,7 @@ class QObjectHelper(Debug):
     def propAttrsFor(self, attr):
         """ Return the most recent property attributes for property,
         potentially updated using registerModelProperties."""
-        attrs = self.classProperties(self.__class__)
-        for entry in attrs:
-            if entry['attr'] == attr:
-                return entry
+        return self._compiledClassProperties(self.__class__)[1].get(attr)
 
     def defaultFor(self, attr):
         """ Calculate a prop's default value based on either ['default'] or ['type']. """
@@ -0,0 +1,38 @@
+def freeze(value):
+    """ Copy containers so the result can't change under a worker thread.
+    Other values are shared; Property.set replaces them rather than
+    mutating them.
+    """
+    kind = type(value)
+    if kind is dict:
+        return { k: freeze(v) for k, v in value.items() }
+    elif kind is list:
+        return [freeze(v) for v in value]
+    elif kind is set:
+        return set(value)
+    return value
+
+
+def frozenChunk(item):
+    chunk = { 'kind': item.__class__.__name__ }
+    item.write(chunk)
+    return { k: freeze(v) for k, v in chunk.items() }
+
+
+class DocumentSnapshot:
+    """ Immutable Item.write() chunks for a whole document, taken on the GUI
+    thread and safe to serialize from any thread.
+
+    Chunks of items that didn't change since the previous snapshot are
+    shared with it rather than written again.
+    """
+
+    __slots__ = ('documentChunk', 'chunks', 'savePoint')
+
+    def __init__(self, documentChunk, chunks, savePoint=None):
+        self.documentChunk = documentChunk
+        self.chunks = tuple(chunks)
+        self.savePoint = savePoint
+
+    def __len__(self):
+        return len(self.chunks)
@@ -0,0 +1,242 @@
+""" Streaming Document codec.
+
+A file is a sequence of length-prefixed pickle records, one per item, so
+neither writing nor reading ever holds more than one item chunk in memory:
+
+    header      { 'version': 1, 'count': n, 'savePoint': token }
+    document    the Document's own properties
+    item * n    { 'kind': 'Person', 'id': 1, ... } from Item.write()
+    delta * m   appended by Document.saveIncremental(), see writeDelta()
+"""
+
+import os, struct, pickle, itertools, gzip
+from .item import Item
+
+
+VERSION = 1
+RECORD_LENGTH = struct.Struct('<Q') # prefix of every record
+
+
+def writeRecord(f, record):
+    data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    f.write(RECORD_LENGTH.pack(len(data)))
+    f.write(data)
+
+
+def readRecord(f):
+    """ Return the next record, or raise EOFError. """
+    header = f.read(RECORD_LENGTH.size)
+    if len(header) < RECORD_LENGTH.size:
+        raise EOFError('Unexpected end of stream')
+    length, = RECORD_LENGTH.unpack(header)
+    data = f.read(length)
+    if len(data) < length:
+        raise EOFError('Truncated record')
+    return pickle.loads(data)
+
+
+def iterRecords(f):
+    while True:
+        try:
+            yield readRecord(f)
+        except EOFError:
+            return
+
+
+def itemKinds(base=Item):
+    """ {class name: class} for every loaded subclass of `base`. """
+    ret = {}
+    todo = [base]
+    while todo:
+        kind = todo.pop()
+        ret.setdefault(kind.__name__, kind)
+        todo.extend(kind.__subclasses__())
+    return ret
+
+
+def writeChunks(document):
+    """ Generator of records for `document`, one item at a time. """
+    document.materializeAll()
+    items = list(document.itemRegistry.values())
+    yield { 'version': VERSION, 'count': len(items), 'savePoint': document.savePoint() }
+    chunk = {}
+    document.write(chunk)
+    yield chunk
+    for item in items:
+        chunk = { 'kind': item.__class__.__name__ }
+        item.write(chunk)
+        yield chunk
+
+
+def writeDocument(document, f, progress=None):
+    """ Write `document` to the binary file `f`. Calls progress(done, total). """
+    records = writeChunks(document)
+    header = next(records)
+    writeRecord(f, header)
+    writeRecord(f, next(records))
+    for i, chunk in enumerate(records):
+        writeRecord(f, chunk)
+        if progress:
+            progress(i + 1, header['count'])
+
+
+def writeDelta(document, f):
+    """ Append one record with what changed since the last save: the
+    values of changed props, and whole chunks for items added or marked
+    with Item.markChunkDirty(). """
+    from .property import Property
+    def values(item, attrs):
+        ret = {}
+        for attr in attrs:
+            meta = item._schema.byAttr.get(attr)
+            if meta is not None:
+                ret[attr] = Property.valueOf(item, meta, forLayers=[])
+        return ret
+    added = []
+    for item in document._dirtyAdded.values():
+        chunk = { 'kind': item.__class__.__name__ }
+        item.write(chunk)
+        added.append(chunk)
+    rewritten = []
+    for id in document._dirtyRewritten:
+        item = document.itemRegistry.get(id)
+        if item is not None:
+            chunk = {}
+            item.write(chunk)
+            rewritten.append(chunk)
+    changed = {}
+    for id, attrs in document._dirtyChanged.items():
+        item = document.itemRegistry.get(id)
+        if item is not None:
+            changed[id] = values(item, attrs)
+    layerValues = {}
+    for id, pairs in document._dirtyLayerValues.items():
+        layer = document.itemRegistry.get(id)
+        if layer is not None:
+            layerValues[id] = [(itemId, attr) + layer.getItemProperty(itemId, attr) for itemId, attr in pairs]
+    record = {
+        'delta': VERSION,
+        'savePoint': document.savePoint(),
+        'document': values(document, document._dirtyDocument),
+        'added': added,
+        'rewritten': rewritten,
+        'changed': changed,
+        'layerValues': layerValues,
+        'removed': list(document._dirtyRemoved)
+    }
+    if document._dirtyDocumentChunk:
+        chunk = {}
+        document.write(chunk)
+        record['documentChunk'] = chunk
+    writeRecord(f, record)
+
+
+def applyDelta(document, delta, kinds=None):
+    """ Replay a writeDelta() record without notifications. """
+    def setValues(item, values):
+        for attr, value in values.items():
+            prop = item.prop(attr)
+            if prop is not None:
+                prop.set(value, notify=False, forLayers=[])
+    if 'documentChunk' in delta:
+        document.read(delta['documentChunk'], document.findById)
+    setValues(document, delta['document'])
+    document._savePoint = delta.get('savePoint')
+    document.setBatchAddingRemovingItems(True)
+    for item in readItems(delta['added'], kinds, byId=document.findById):
+        old = document.itemRegistry.get(item.id)
+        if old is not None: # removed and re-added
+            document.removeItem(old)
+        document.addItem(item)
+    for chunk in delta.get('rewritten', ()):
+        item = document.itemRegistry.get(chunk.get('id'))
+        if item is not None:
+            item.read(chunk, document.findById)
+    for id, values in delta['changed'].items():
+        item = document.itemRegistry.get(id)
+        if item is not None:
+            setValues(item, values)
+    for id, entries in delta['layerValues'].items():
+        layer = document.itemRegistry.get(id)
+        if layer is not None:
+            layer.setItemPropertiesMany([(itemId, attr, value) for itemId, attr, value, ok in entries if ok])
+            layer.resetItemPropertiesMany([(itemId, attr) for itemId, attr, value, ok in entries if not ok])
+    for id in delta['removed']:
+        item = document.itemRegistry.get(id)
+        if item is not None:
+            document.removeItem(item)
+    document.setBatchAddingRemovingItems(False)
+    document.updateActiveLayers() # 'active' may have been replayed without notify
+
+
+def writeSnapshot(snapshot, path, compress=False):
+    """ Write a Document.snapshot() to `path`. Safe to call from a worker
+    thread. Writes to a temp file first so a failed save never leaves a
+    half-written file behind.
+    """
+    tmpPath = path + '.tmp'
+    opener = gzip.open if compress else open
+    with opener(tmpPath, 'wb') as f:
+        writeRecord(f, { 'version': VERSION, 'count': len(snapshot), 'savePoint': snapshot.savePoint })
+        writeRecord(f, snapshot.documentChunk)
+        for chunk in snapshot.chunks:
+            writeRecord(f, chunk)
+    os.replace(tmpPath, path)
+
+
+def openFile(path):
+    """ Open a stream file for reading, compressed or not. """
+    f = open(path, 'rb')
+    if f.read(2) == b'\x1f\x8b':
+        f.close()
+        return gzip.open(path, 'rb')
+    f.seek(0)
+    return f
+
+
+def readItems(records, kinds=None, byId=None):
+    """ Generator of unregistered items from item records. """
+    if kinds is None:
+        kinds = itemKinds()
+    for chunk in records:
+        kindName = chunk.pop('kind', None) # not an attr, don't keep it as a forward compat value
+        kind = kinds.get(kindName)
+        if kind is None:
+            raise ValueError('Unknown item kind: %s' % kindName)
+        item = kind()
+        item.read(chunk, byId)
+        yield item
+
+
+def readDocument(document, f, kinds=None, progress=None, batchSize=1000):
+    """ Read items from `f` into `document`, adding them in batches of
+    `batchSize` so progress(done, total) can update the GUI in between.
+    """
+    records = iterRecords(f)
+    header = next(records, None)
+    if header is None:
+        raise EOFError('Empty stream')
+    if header.get('version', 0) > VERSION:
+        raise ValueError('Unsupported stream version: %s' % header.get('version'))
+    document._savePoint = header.get('savePoint')
+    batch = {}
+    def byId(id):
+        return batch.get(id) or document.findById(id)
+    document.read(next(records), byId)
+    total = header['count']
+    done = 0
+    def flush():
+        document.addItems(*batch.values())
+        batch.clear()
+        if progress:
+            progress(done, total)
+    for item in readItems(itertools.islice(records, total), kinds, byId=byId):
+        batch[item.id] = item
+        done += 1
+        if len(batch) >= batchSize:
+            flush()
+    if batch:
+        flush()
+    for delta in records:
+        applyDelta(document, delta, kinds)
+    document.clearDirty()
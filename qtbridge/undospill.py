@@ -0,0 +1,51 @@
+""" Byte accounting and spill storage for old undo commands. """
+
+import sys, tempfile, pickle
+
+
+def estimateSize(value):
+    """ Rough recursive size of plain containers in bytes. Anything else,
+    i.e. items and props, is counted shallow since the document owns them.
+    """
+    size = sys.getsizeof(value)
+    kind = type(value)
+    if kind is dict:
+        for k, v in value.items():
+            size += estimateSize(k) + estimateSize(v)
+    elif kind in (list, tuple, set, frozenset):
+        for x in value:
+            size += estimateSize(x)
+    return size
+
+
+class SpillFile:
+    """ Append-only temp file of pickled undo payloads, read back by offset.
+    Space is only reclaimed by clear().
+    """
+
+    def __init__(self):
+        self._file = None
+
+    def write(self, payload):
+        """ Return the offset to pass to read(). """
+        if self._file is None:
+            self._file = tempfile.TemporaryFile(prefix='qtbridge-undo-')
+        self._file.seek(0, 2)
+        offset = self._file.tell()
+        pickle.dump(payload, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+        return offset
+
+    def read(self, offset):
+        self._file.seek(offset)
+        return pickle.load(self._file)
+
+    def size(self):
+        if self._file is None:
+            return 0
+        self._file.seek(0, 2)
+        return self._file.tell()
+
+    def clear(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,63 @@
+import weakref
+
+
+class WeakOrderedSet:
+    """ Insertion-ordered set of weak references with O(1) add and discard.
+    Objects drop out on their own once garbage collected. Membership is by
+    identity. Objects that can't be weakly referenced are held strongly.
+    """
+
+    __slots__ = ('_refs', '__weakref__')
+
+    def __init__(self, items=()):
+        self._refs = None # {id(x): ref}, allocated on first add
+        for x in items:
+            self.add(x)
+
+    def add(self, x):
+        refs = self._refs
+        if refs is None:
+            refs = self._refs = {}
+        key = id(x)
+        if key in refs:
+            return
+        try:
+            refs[key] = weakref.ref(x, self._onCollected(key))
+        except TypeError:
+            refs[key] = lambda: x
+
+    def _onCollected(self, key):
+        selfRef = weakref.ref(self)
+        def callback(ref):
+            self = selfRef()
+            if self is not None and self._refs is not None and self._refs.get(key) is ref:
+                del self._refs[key]
+        return callback
+
+    def discard(self, x):
+        if self._refs:
+            self._refs.pop(id(x), None)
+
+    def remove(self, x):
+        if not self._refs or self._refs.pop(id(x), None) is None:
+            raise KeyError(x)
+
+    def __contains__(self, x):
+        if not self._refs:
+            return False
+        ref = self._refs.get(id(x))
+        return ref is not None and ref() is x
+
+    def __len__(self):
+        return len(self._refs) if self._refs else 0
+
+    def __iter__(self):
+        """ Iterates over a copy so the set can change while iterating. """
+        if not self._refs:
+            return iter(())
+        ret = []
+        for ref in list(self._refs.values()):
+            x = ref()
+            if x is not None:
+                ret.append(x)
+        return iter(ret)
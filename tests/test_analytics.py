@@ -0,0 +1,45 @@
+import json
+from qtbridge import analytics, commands
+
+
+def read(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_batches_to_sink(tmp_path):
+    path = str(tmp_path / 'events.jsonl')
+    queue = analytics.AnalyticsQueue(analytics.FileSink(path), batchSize=2, interval=60)
+    for i in range(5):
+        queue.enqueue('Commands: Set num', { 'i': i })
+    queue.stop()
+    events = read(path)
+    assert [event['properties']['i'] for event in events] == [0, 1, 2, 3, 4]
+    assert queue.pending() == 0
+    assert queue.sent == 5
+
+
+def test_drops_under_back_pressure(tmp_path):
+    path = str(tmp_path / 'events.jsonl')
+    queue = analytics.AnalyticsQueue(analytics.FileSink(path), maxQueued=3, batchSize=100, interval=60)
+    for i in range(10):
+        queue.enqueue('Commands: Set num')
+    assert queue.pending() == 4 # 3 queued + 1 aggregate
+    queue.stop()
+    events = read(path)
+    assert len(events) == 4
+    assert events[-1]['properties'] == { 'dropped': 7 }
+
+
+def test_stack_track_is_queued(tmp_path):
+    path = str(tmp_path / 'events.jsonl')
+    stack = commands.stack()
+    stack.setAnalyticsSink(analytics.FileSink(path))
+    stack.setAnalyticsEnabled(True)
+    try:
+        commands.trackAction('Open file')
+        stack.analytics().stop()
+        assert read(path)[0]['event'] == 'Action: Open file'
+    finally:
+        stack.setAnalyticsEnabled(False)
+        stack.setAnalyticsSink(analytics.NullSink())
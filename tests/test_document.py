@@ -1,9 +1,9 @@
-import os, os.path, pickle
+import os, os.path, pickle, io, concurrent.futures
 import pytest
 import conftest
 from conftest import Person
 from qtbridge.pyqt import QDate, QPointF, QRectF
-from qtbridge import util, commands, Document, Item, Layer, LayerModel
+from qtbridge import util, commands, stream, container, parallel, journal, Document, Item, Layer, LayerModel
 
 
 def test_find_by_types(simpleDocument):
@@ -440,3 +440,487 @@ def test_save_load_delete_items(qtbot, qApp):
     qtbot.clickYesAfter(lambda: document.removeSelection()) # would throw exception
 
 
+
+
+def test_indexed_find_matches_scan(qApp):
+
+    def build(indexed):
+        document = Document()
+        if indexed:
+            document.enableIndexes(['name'])
+        people = [Person(name='p%i' % (i % 3)) for i in range(9)]
+        document.addItems(*people)
+        people[0].setTags(['here'])
+        people[1].setTags(['here', 'there'])
+        people[2].prop('tags').set(['there'], notify=False)
+        return document
+
+    scanned = build(False)
+    indexed = build(True)
+    assert indexed.isIndexed('name')
+    assert not indexed.isIndexed('tags')
+    for kwargs in ({ 'types': Person }, { 'tags': 'here' }, { 'tags': ['there'] }, { 'tags': 'here', 'types': Person }):
+        assert [x.id for x in indexed.find(**kwargs)] == [x.id for x in scanned.find(**kwargs)]
+    assert [x.id for x in indexed.query(name='p1')] == [x.id for x in scanned.query(name='p1')]
+
+    person = indexed.query1(name='p1')
+    person.setName('p4')
+    assert indexed.query(name='p4') == [person]
+    indexed.removeItem(person)
+    assert indexed.query(name='p4') == []
+
+
+def test_transaction_coalesces(qApp):
+    commands.stack().clear()
+    document = Document()
+    itemAdded = util.Condition(document.itemAdded)
+    propertyChanged = util.Condition(document.propertyChanged)
+    changesCommitted = util.Condition(document.changesCommitted)
+
+    with document.transaction('Import people'):
+        people = [Person(name='p%i' % i) for i in range(10)]
+        for person in people:
+            document.addItem(person)
+            person.setName('one', undo=True)
+            person.setName('two', undo=True)
+        assert itemAdded.callCount == 0
+        assert propertyChanged.callCount == 0
+    assert itemAdded.callCount == 10
+    assert propertyChanged.callCount == 10 # one per (item, attr)
+    assert changesCommitted.callCount == 1
+    assert len(changesCommitted.lastCallArgs[0]['added']) == 10
+    assert commands.stack().count() == 1
+
+    commands.stack().undo()
+    assert [person.name() for person in people] == ['p%i' % i for i in range(10)]
+
+    with document.transaction():
+        pass
+    assert commands.stack().count() == 1 # no empty macro
+    assert changesCommitted.callCount == 1
+
+    with document.transaction():
+        people[0].setName('gone')
+        people[1].setName('kept')
+        document.removeItem(people[0])
+    assert [prop.item for prop in changesCommitted.lastCallArgs[0]['changed']] == [people[1]]
+
+    class Subscriber:
+        def __init__(self):
+            self.attrs = []
+        def onItemProperty(self, prop):
+            self.attrs.append((prop.item.id, prop.name()))
+
+    byKind, listener = Subscriber(), Subscriber()
+    document.dispatcher().subscribe(byKind, 'name', kind=Person)
+    people[2].addPropertyListener(listener)
+    with document.transaction():
+        people[2].setName('one')
+        people[2].setName('two')
+        assert byKind.attrs == []
+        assert listener.attrs == []
+    assert byKind.attrs == [(people[2].id, 'name')]
+    assert listener.attrs == [(people[2].id, 'name')]
+    assert [prop.item for prop in changesCommitted.lastCallArgs[0]['changed']] == [people[2]]
+
+
+def test_batched_signals(qApp):
+    document = Document()
+    itemsAdded = util.Condition(document.itemsAdded)
+    itemsRemoved = util.Condition(document.itemsRemoved)
+    propertiesChanged = util.Condition(document.propertiesChanged)
+
+    people = [Person(name='p%i' % i) for i in range(3)]
+    document.addItems(*people)
+    assert itemsAdded.callCount == 1
+    assert itemsAdded.lastCallArgs == (people,)
+
+    for person in people:
+        person.setName('one')
+        person.setName('two')
+    assert propertiesChanged.callCount == 0 # next event loop tick
+    qApp.processEvents()
+    assert propertiesChanged.callCount == 1
+    assert len(propertiesChanged.lastCallArgs[0]) == 3
+
+    document.removeItem(people[0])
+    assert itemsRemoved.callCount == 1
+    assert itemsRemoved.lastCallArgs == ([people[0]],)
+
+
+def test_reserve_ids(qApp):
+    document = Document()
+    assert document.reserveIds(3) == range(0, 3)
+    assert document.lastItemId() == 2
+
+    people = [Person(name='p%i' % i) for i in range(4)]
+    people[3].id = 10
+    document.addItems(*people)
+    assert [person.id for person in people] == [11, 12, 13, 10]
+    assert document.lastItemId() == 13
+
+    clones = document.cloneItems(people[:2])
+    assert [clone.id for clone in clones] == [14, 15]
+    assert clones[1].name() == 'p1'
+    assert document.nextId() == 16
+
+def test_stream_write_read(qApp):
+    document = Document()
+    layer = Layer(name='Layer 1')
+    people = [Person(name='p%i' % i) for i in range(5)]
+    document.addItems(layer, *people)
+    f = io.BytesIO()
+    stream.writeDocument(document, f)
+
+    f.seek(0)
+    progress = []
+    document2 = Document()
+    stream.readDocument(document2, f, batchSize=2, progress=lambda done, total: progress.append((done, total)))
+    assert progress == [(2, 6), (4, 6), (6, 6)]
+    assert document2.lastItemId() == document.lastItemId()
+    assert document2.find(people[3].id).name() == 'p3'
+    assert document2.find(layer.id).name() == 'Layer 1'
+
+
+def test_container_lazy_open(qApp, tmp_path):
+    document = Document()
+    layer = Layer(name='Layer 1')
+    people = [Person(name='p%i' % i) for i in range(10)]
+    document.addItems(layer, *people)
+    path = str(tmp_path / 'document.qtb')
+    container.writeContainer(document, path)
+
+    document2 = Document()
+    document2.openLazy(path)
+    assert document2.unloadedCount() == 10 # layers are loaded right away
+    assert document2.find(layer.id).name() == 'Layer 1'
+    assert document2.find(people[4].id).name() == 'p4'
+    assert document2.unloadedCount() == 9
+
+    itemAdded = util.Condition(document2.itemAdded)
+    assert len(document2.find(types=Person)) == 10 # scans load everything
+    assert not document2.isLazy()
+    assert itemAdded.callCount == 0 # loading isn't adding
+    assert not document2.isDirty()
+
+
+def test_save_over_lazy_file(qApp, tmp_path):
+    document = Document()
+    people = [Person(name='p%i' % i) for i in range(10)]
+    document.addItems(*people)
+    path = str(tmp_path / 'document.qtb')
+    container.writeContainer(document, path)
+
+    document2 = Document()
+    document2.openLazy(path)
+    document2.find(people[4].id).setName('changed')
+    container.writeContainer(document2, path) # loads the rest before replacing the file
+    assert document2.unloadedCount() == 0
+
+    document3 = Document()
+    document3.openLazy(path)
+    assert document3.find(people[4].id).name() == 'changed'
+    assert document3.find(people[9].id).name() == 'p9'
+    document3.saveFull(path) # stream format from here on
+    document4 = Document()
+    with stream.openFile(path) as f:
+        stream.readDocument(document4, f)
+    assert [x.name() for x in document4.find(types=Person)] == [x.name() for x in document3.find(types=Person)]
+
+
+def test_incremental_save(qApp, tmp_path):
+    path = str(tmp_path / 'document.qtbs')
+    document = Document()
+    people = [Person(name='p%i' % i) for i in range(20)]
+    document.addItems(*people)
+    assert document.saveIncremental(path) == True # first save is a full snapshot
+    assert not document.isDirty()
+    size = os.path.getsize(path)
+
+    people[3].setName('changed')
+    document.removeItem(people[4])
+    assert document.isDirty()
+    assert document.saveIncremental(path) == False # appended a delta
+    assert os.path.getsize(path) - size < size / 4
+
+    document2 = Document()
+    with open(path, 'rb') as f:
+        stream.readDocument(document2, f)
+    assert document2.find(people[3].id).name() == 'changed'
+    assert document2.find(people[4].id) is None
+    assert not document2.isDirty()
+
+
+class Numbered(Item):
+
+    Item.registerProperties((
+        { 'attr': 'num', 'type': int, 'default': -1, 'layered': True },
+    ))
+
+
+def test_read_batches_under_active_layer(qApp, tmp_path):
+    path = str(tmp_path / 'document.qtbs')
+    document = Document()
+    layer = Layer(name='Layer 1', active=True)
+    things = [Numbered(num=i) for i in range(25)]
+    document.addItems(layer, *things)
+    layer.setItemPropertiesMany([(thing.id, 'num', 100 + i) for i, thing in enumerate(things)])
+    document.saveFull(path)
+
+    document2 = Document()
+    with stream.openFile(path) as f:
+        stream.readDocument(document2, f, batchSize=10) # the layer is in the first batch
+    assert [document2.find(thing.id).num() for thing in things] == list(range(100, 125))
+
+
+def test_getter_does_not_depend_on_prop(qApp):
+    document = Document()
+    layer = Layer(name='Layer 1', active=True)
+    document.addItem(layer)
+    thing = Numbered(num=1)
+    thing.id = document.nextId()
+    layer.setItemProperty(thing.id, 'num', 2)
+    document.addItem(thing)
+    assert thing.num() == 2 # before any Property is allocated
+    assert thing.prop('num').get() == 2
+    assert thing.num() == 2
+
+    document.removeItem(thing)
+    assert thing.num() == 1
+    document.addItem(thing)
+    assert thing.num() == 2
+
+
+class Annotated(Item):
+    """ Writes a key of its own, like Event.write() in the README. """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.notes = []
+
+    def write(self, chunk):
+        super().write(chunk)
+        chunk['notes'] = list(self.notes)
+
+    def read(self, chunk, byId):
+        super().read(chunk, byId)
+        self.notes = list(chunk.get('notes', []))
+
+
+def test_mark_chunk_dirty(qApp, tmp_path):
+    path = str(tmp_path / 'document.qtbs')
+    document = Document()
+    annotated = Annotated()
+    document.addItems(annotated, Person(name='p'))
+    document.saveIncremental(path)
+    document.snapshot() # chunks are cached from here on
+
+    annotated.notes.append('hello')
+    annotated.markChunkDirty()
+    assert document.isDirty()
+    assert [x['notes'] for x in document.snapshot().chunks if x['id'] == annotated.id] == [['hello']]
+    assert document.saveIncremental(path) == False # a delta with the whole chunk
+
+    document2 = Document()
+    with open(path, 'rb') as f:
+        stream.readDocument(document2, f)
+    assert document2.find(annotated.id).notes == ['hello']
+
+
+def test_snapshot_save_in_background(qApp, tmp_path):
+    document = Document()
+    layer = Layer(name='Layer 1')
+    people = [Person(name='p%i' % i) for i in range(10)]
+    document.addItems(layer, *people)
+    snapshot1 = document.snapshot()
+    people[2].setName('changed')
+    snapshot2 = document.snapshot()
+    assert snapshot2.chunks[0] is snapshot1.chunks[0] # unchanged items are shared
+    assert [x['name'] for x in snapshot2.chunks if x['id'] == people[2].id] == ['changed']
+
+    path = str(tmp_path / 'document.qtbs')
+    saveFinished = util.Condition(document.saveFinished)
+    document.saveInBackground(path, compress=True)
+    assert saveFinished.wait() == True
+    assert saveFinished.lastCallArgs == (path, True)
+
+    document2 = Document()
+    with stream.openFile(path) as f:
+        stream.readDocument(document2, f)
+    assert document2.find(people[2].id).name() == 'changed'
+
+
+class NotedDocument(Document):
+
+    def write(self, chunk):
+        super().write(chunk)
+        chunk['notes'] = 'here'
+
+
+def test_save_in_background_dirty_state(qApp, tmp_path):
+    document = NotedDocument()
+    people = [Person(name='p%i' % i) for i in range(3)]
+    document.addItems(*people)
+    assert document.snapshot().documentChunk['notes'] == 'here'
+
+    badPath = str(tmp_path / 'missing' / 'document.qtbs')
+    saveFinished = util.Condition(document.saveFinished)
+    document.saveInBackground(badPath)
+    people[0].setName('during')
+    assert saveFinished.wait() == True
+    assert saveFinished.lastCallArgs == (badPath, False)
+    assert document.isDirty()
+    assert document._dirtyAdded.keys() == {person.id for person in people}
+
+    document.saveInBackground(str(tmp_path / 'document.qtbs'))
+    people[1].setName('during')
+    document.waitForSave()
+    assert document._dirtyChanged == {people[1].id: {'name'}}
+    document.clearDirty()
+    assert not document.isDirty()
+
+
+def test_read_parallel(qApp, tmp_path):
+    path = str(tmp_path / 'document.qtbs')
+    document = Document()
+    layer = Layer(name='Layer 1')
+    people = [Person(name='p%i' % i) for i in range(10)]
+    document.addItems(layer, *people)
+    document.saveFull(path)
+
+    document2 = Document()
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        parallel.readDocumentParallel(document2, path, executor=executor, batchSize=4)
+    assert document2.lastItemId() == document.lastItemId()
+    for item in document.itemRegistry.values():
+        chunk1, chunk2 = {}, {}
+        item.write(chunk1)
+        document2.find(item.id).write(chunk2)
+        assert chunk1 == chunk2
+
+
+def test_read_parallel_under_active_layer(qApp, tmp_path):
+    path = str(tmp_path / 'document.qtbs')
+    document = Document()
+    layer = Layer(name='Layer 1', active=True)
+    things = [Numbered(num=i) for i in range(25)]
+    document.addItems(layer, *things)
+    layer.setItemPropertiesMany([(thing.id, 'num', 100 + i) for i, thing in enumerate(things)])
+    document.saveFull(path)
+
+    document2 = Document()
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        parallel.readDocumentParallel(document2, path, executor=executor, batchSize=10)
+    assert [document2.find(thing.id).num() for thing in things] == list(range(100, 125))
+
+
+def test_journal_replay(qApp, tmp_path):
+    path = str(tmp_path / 'document.qtbs')
+    journalPath = str(tmp_path / 'journal.qtbj')
+    commands.stack().clear()
+    document = Document()
+    layer = Layer(name='Layer 1')
+    people = [Person(name='p%i' % i) for i in range(3)]
+    document.addItems(layer, *people)
+    commands.stack().setJournal(journal.CommandJournal(journalPath))
+    try:
+        document.saveFull(path) # starts the journal at this save point
+        people[0].setName('one', undo=True)
+        people[1].setName('two', undo=True)
+        commands.stack().undo()
+        commands.addItem(document, Person(name='new'))
+        commands.stack().journal().sync()
+    finally:
+        commands.stack().journal().close()
+        commands.stack().setJournal(None)
+
+    document2 = Document()
+    with open(path, 'rb') as f:
+        stream.readDocument(document2, f)
+    changesCommitted = util.Condition(document2.changesCommitted)
+    assert journal.replayJournal(document2, journalPath) == 4
+    assert changesCommitted.callCount == 1
+    assert document2.find(people[0].id).name() == 'one'
+    assert document2.find(people[1].id).name() == 'p1'
+    assert [x.name() for x in document2.find(types=Person)][-1] == 'new'
+
+    other = Document()
+    other.addItems(Person(name='other'))
+    otherPath = str(tmp_path / 'other.qtbs')
+    other.saveFull(otherPath)
+    document3 = Document()
+    with open(otherPath, 'rb') as f:
+        stream.readDocument(document3, f)
+    assert journal.replayJournal(document3, journalPath) == 0 # some other file
+    assert [x.name() for x in document3.find(types=Person)] == ['other']
+
+
+def test_journal_replay_tags(qApp, tmp_path):
+    path = str(tmp_path / 'document.qtbs')
+    journalPath = str(tmp_path / 'journal.qtbj')
+    commands.stack().clear()
+    document = Document()
+    people = [Person(name='p%i' % i, tags=['here']) for i in range(2)]
+    document.addItems(*people)
+    commands.stack().setJournal(journal.CommandJournal(journalPath))
+    try:
+        document.saveFull(path)
+        document.setTags(['here', 'there'], undo=True)
+        commands.setTag(people[0], 'there')
+        commands.unsetTag(people[1], 'here')
+        commands.stack().journal().sync()
+    finally:
+        commands.stack().journal().close()
+        commands.stack().setJournal(None)
+
+    document2 = Document()
+    with open(path, 'rb') as f:
+        stream.readDocument(document2, f)
+    assert journal.replayJournal(document2, journalPath) == 3
+    assert document2.tags() == ['here', 'there']
+    assert document2.find(people[0].id).tags() == ['here', 'there']
+    assert document2.find(people[1].id).tags() == []
+
+
+def test_property_dispatcher(qApp):
+    document = Document()
+    people = [Person(name='p%i' % i) for i in range(3)]
+    document.addItems(*people)
+    assert not document in people[0].propertyListeners
+
+    class Subscriber:
+        def __init__(self):
+            self.attrs = []
+        def onItemProperty(self, prop):
+            self.attrs.append((prop.item.id, prop.name()))
+
+    byItem, byKind, bySelection = Subscriber(), Subscriber(), Subscriber()
+    dispatcher = document.dispatcher()
+    dispatcher.subscribe(byItem, 'name', itemId=people[0].id)
+    dispatcher.subscribe(byKind, 'name', kind=Person)
+    dispatcher.subscribe(bySelection, 'name', kind=Person)
+    dispatcher.subscribeItems(bySelection, {people[1].id})
+
+    people[0].setName('one')
+    people[1].setName('two')
+    people[1].setTags(['hello'])
+    assert byItem.attrs == [(people[0].id, 'name')]
+    assert byKind.attrs == [(people[0].id, 'name'), (people[1].id, 'name')]
+    assert bySelection.attrs == [(people[0].id, 'name'), (people[1].id, 'name'), (people[1].id, 'tags')]
+
+    del byKind
+    import gc; gc.collect()
+    assert dispatcher.subscriberCount() == 3
+    dispatcher.unsubscribeItems(bySelection)
+    assert dispatcher.subscriberCount() == 2
+
+    dispatcher.unsubscribe(bySelection, 'name', kind=Person)
+    dispatcher.subscribeItems(bySelection, {people[0].id}, attr='name')
+    dispatcher.subscribeItems(bySelection, {people[2].id}, attr='name') # replaces the selection
+    bySelection.attrs = []
+    people[0].setName('zero')
+    people[2].setName('two')
+    assert bySelection.attrs == [(people[2].id, 'name')]
+    del bySelection
+    gc.collect()
+    assert dispatcher._bySelection == {}
@@ -1,4 +1,4 @@
-from qtbridge import Document, Item, Layer, commands
+from qtbridge import util, Document, Item, Layer, commands
 
 def test_forward_compat():
     # simulate future version with additional props
@@ -193,6 +193,277 @@ def test_layered_property_undo_redo(qApp):
 
 
 
+def test_undo_merge_keeps_first_was(qApp):
+    commands.stack().clear()
+    document = Document()
+    items = [LayeredItem(num=i) for i in range(3)]
+    document.addItems(*items)
+    id = commands.nextId()
+    for value in (10, 20, 30):
+        for item in items:
+            item.setNum(value, undo=id)
+    assert commands.stack().count() == 1
+    assert len(commands.stack().command(0).data) == 3 # one entry per (layer, item, attr)
+
+    commands.stack().undo()
+    assert [item.num() for item in items] == [0, 1, 2]
+    commands.stack().redo()
+    assert [item.num() for item in items] == [30, 30, 30]
+
+
+def test_set_item_properties_converts(qApp):
+    commands.stack().clear()
+    document = Document()
+    layer = Layer(name='Layer 1', active=True)
+    items = [LayeredItem() for i in range(3)]
+    document.addItems(layer, *items)
+    props = [item.prop('num') for item in items]
+    commands.stack().push(commands.SetItemProperties(props, '7'))
+    for prop in props:
+        prop.set('7')
+    assert [entry['value'] for entry in commands.stack().command(0).data.values()] == [7, 7, 7]
+
+    commands.stack().undo()
+    assert layer.itemProperties() == {}
+    commands.stack().redo()
+    assert layer.getItemProperty(items[0].id, 'num') == (7, True)
+    assert [item.num() for item in items] == [7, 7, 7]
+
+
+def test_undo_coalesces_notifications(qApp):
+    commands.stack().clear()
+    document = Document()
+    layer = Layer(name='Layer 1', active=True)
+    items = [LayeredItem() for i in range(3)]
+    document.addItems(layer, *items)
+    id = commands.nextId()
+    for value in (10, 20, 30):
+        for item in items:
+            item.setNum(value, undo=id)
+    for item in items:
+        item.count = 0
+    propertyChanged = util.Condition(document.propertyChanged)
+    propertiesChanged = util.Condition(document.propertiesChanged)
+
+    commands.stack().undo()
+    assert [item.num() for item in items] == [-1, -1, -1]
+    assert [item.count for item in items] == [1, 1, 1] # once per (item, attr)
+    assert propertyChanged.callCount == 3
+    qApp.processEvents()
+    assert propertiesChanged.callCount == 1
+    assert len(propertiesChanged.lastCallArgs[0]) == 3
+
+    commands.stack().redo()
+    assert [item.num() for item in items] == [30, 30, 30]
+    assert [item.count for item in items] == [2, 2, 2]
+    assert propertyChanged.callCount == 6
+
+
+def test_undo_from_qt_slots(qApp):
+    stack = commands.stack()
+    stack.clear()
+    stack.setInstrumented(True)
+    document = Document()
+    layer = Layer(name='Layer 1', active=True)
+    items = [LayeredItem() for i in range(3)]
+    document.addItems(layer, *items)
+    id = commands.nextId()
+    for value in (10, 20):
+        for item in items:
+            item.setNum(value, undo=id)
+    for item in items:
+        item.count = 0
+
+    stack.createUndoAction(stack).trigger() # C++ slot, no Python override involved
+    assert [item.num() for item in items] == [-1, -1, -1]
+    assert [item.count for item in items] == [1, 1, 1]
+    stack.setIndex(1)
+    assert [item.num() for item in items] == [20, 20, 20]
+    assert [item.count for item in items] == [2, 2, 2]
+    assert stack.stats().count('SetItemProperty', 'undo') == 1
+    assert stack.stats().count('SetItemProperty', 'redo') == 1
+
+    stack.command(0).undo() # not driven by the stack, so no indexChanged
+    assert [item.num() for item in items] == [-1, -1, -1]
+    assert [item.count for item in items] == [3, 3, 3]
+    item = items[0]
+    item.setNum(30)
+    assert item.count == 4
+    stack.setInstrumented(False)
+
+
+def test_undo_spill_to_disk(qApp):
+    stack = commands.stack()
+    stack.clear()
+    document = Document()
+    items = [LayeredItem(num=i) for i in range(20)]
+    document.addItems(*items)
+    for value in range(10):
+        id = commands.nextId()
+        for item in items:
+            item.setNum(value * 100, undo=id)
+    memory = stack.memoryUsage()
+    stack.setMaxBytes(memory // 2)
+    stats = stack.memoryStats()
+    assert stats['spilledCommands'] > 0
+    assert stats['bytes'] <= memory // 2
+    assert stats['spillFileBytes'] > 0
+
+    for i in range(stack.count()):
+        stack.undo()
+    assert [item.num() for item in items] == list(range(20))
+    for i in range(stack.count()):
+        stack.redo()
+    assert [item.num() for item in items] == [900] * 20
+    stack.setMaxBytes(stack.MAX_BYTES)
+    stack.clear()
+
+
+def test_undo_spill_over_budget_is_linear(qApp, monkeypatch):
+    stack = commands.stack()
+    stack.clear()
+    stack.setMaxBytes(1) # AddItem can't spill, so this stays exceeded
+    calls = []
+    sizeEstimate = commands.UndoCommand.sizeEstimate
+    def counted(self):
+        calls.append(self)
+        return sizeEstimate(self)
+    monkeypatch.setattr(commands.UndoCommand, 'sizeEstimate', counted)
+    document = Document()
+    for i in range(300):
+        commands.addItem(document, LayeredItem())
+    assert len(calls) < 300 * 5 # not once per command per push
+    monkeypatch.undo()
+    stack.setMaxBytes(stack.MAX_BYTES)
+    stack.clear()
+
+
+def test_undo_stats(qApp):
+    stack = commands.stack()
+    stack.clear()
+    stack.setInstrumented(True)
+    timed = util.Condition(stack.commandTimed)
+    document = Document()
+    items = [LayeredItem() for i in range(3)]
+    document.addItems(*items)
+    id = commands.nextId()
+    for item in items:
+        item.setNum(1, undo=id)
+    stack.undo()
+    stack.redo()
+
+    stats = stack.stats()
+    assert stats.count('SetItemProperty', 'push') == 1
+    assert stats.count('SetItemProperty', 'merge') == 2
+    assert stats.count('SetItemProperty', 'undo') == 1
+    assert stats.count('SetItemProperty', 'redo') == 1
+    assert stats.report()['SetItemProperty']['bytes']['count'] == 3
+    assert 'SetItemProperty' in stats.toJson()
+    assert timed.callCount == 5
+    stack.setInstrumented(False)
+    assert stack.stats() is None
+
+
+def test_property_listeners_weak(qApp):
+    import gc
+
+    class Listener:
+        def __init__(self):
+            self.props = []
+        def onItemProperty(self, prop):
+            self.props.append(prop.name())
+
+    item = LayeredItem()
+    a, b = Listener(), Listener()
+    item.addPropertyListener(a)
+    item.addPropertyListener(b)
+    item.addPropertyListener(a)
+    assert item.propertyListenerCount() == 2
+    assert list(item.propertyListeners) == [a, b]
+
+    item.setNum(1)
+    assert a.props == ['num'] and b.props == ['num']
+
+    del b
+    gc.collect()
+    assert item.propertyListenerCount() == 1
+    item.removePropertyListener(a)
+    item.removePropertyListener(a)
+    assert item.propertyListenerCount() == 0
+
+
+def test_property_setDebug():
+    prop = Item(tags=['a']).prop('tags')
+    assert prop.DEBUG == Item.DEBUG
+    prop.setDebug(False)
+    assert prop.DEBUG is False
+    assert Item().prop('tags').DEBUG == Item.DEBUG
+
+
+def test_class_level_accessors():
+    item = LayeredItem()
+    assert 'num' in LayeredItem.__dict__
+    assert 'setNum' in LayeredItem.__dict__
+    assert 'resetNum' in LayeredItem.__dict__
+    assert not 'num' in item.__dict__
+    assert item._propCache == {} # nothing allocated until accessed
+
+    item.setNum(5)
+    assert list(item._propCache.keys()) == ['num']
+    assert item.num() == 5
+    item.resetNum()
+    assert item.num() == -1
+
+
+def test_shared_schema_compact_values():
+    a = LayeredItem()
+    b = LayeredItem()
+    assert a._schema is b._schema
+    assert len(a._values) == len(a._schema)
+
+    a.setNum(3)
+    assert a._values[a._schema.byAttr['num'].index] == 3
+    assert b.num() == -1
+    assert a.tags() is not b.tags() # mutable defaults are not shared
+
+
+def test_classProperties_memoized():
+    entries = Item.classProperties(LayeredItem)
+    assert Item.classProperties(LayeredItem) is entries
+
+    class Other(Item):
+        Item.registerProperties((
+            { 'attr': 'other' },
+        ))
+
+    assert Item.classProperties(LayeredItem) is not entries # invalidated
+    assert Item.classProperties(LayeredItem) == entries
+
+
+
+def test_read_compiled():
+    class Typed(Item):
+        Item.registerProperties((
+            { 'attr': 'count', 'type': int, 'default': 0 },
+            { 'attr': 'name', 'type': str, 'strip': True },
+            { 'attr': 'tags', 'type': list, 'default': [] },
+        ))
+
+    chunk = { 'id': 5, 'count': '12', 'name': ' bob ', 'tags': [], 'future': 1 }
+    item = Typed()
+    item.read(chunk, None)
+    assert item.id == 5
+    assert item.count() == 12
+    assert item.name() == 'bob'
+    assert item._values[item._schema.byAttr['tags'].index] is None # default not copied
+    assert item._readChunk == { 'future': 1 } # only unknown keys retained
+
+    out = {}
+    item.write(out)
+    assert out['future'] == 1
+    assert out['count'] == 12
+
+
     
 # def test_class_defs():
 #     """ Test migration from properties defined in instance to defined in class, particular onset callback references. """
@@ -531,3 +531,154 @@ def tests_duplicate(qApp):
     
     layer2 = layer1.clone(document)
     assert layer2.id in callout.layers()
+
+
+
+class LayeredThing(Item):
+
+    Item.registerProperties((
+        { 'attr': 'num', 'default': -1, 'layered': True },
+    ))
+
+
+def test_activate_touches_only_overrides(qApp, monkeypatch):
+    document = Document()
+    layer = Layer(name='Layer 1', active=True)
+    things = [LayeredThing() for i in range(10)]
+    document.addItems(layer, *things)
+    things[3].setNum(3) # stored on the active layer
+    assert layer.getItemProperty(things[3].id, 'num') == (3, True)
+
+    updated = []
+    updateLayeredProperties = Item.updateLayeredProperties
+    def _updateLayeredProperties(self, attrs):
+        updated.append((self, set(attrs)))
+        updateLayeredProperties(self, attrs)
+    monkeypatch.setattr(Item, 'updateLayeredProperties', _updateLayeredProperties)
+
+    layer.setActive(False)
+    assert updated == [(things[3], {'num'})]
+    assert things[3].num() == -1
+
+    layer.setActive(True)
+    assert things[3].num() == 3
+
+
+def test_composite_stacked_layers(qApp):
+    document = Document()
+    layer1 = Layer(name='Layer 1')
+    layer2 = Layer(name='Layer 2')
+    thing = LayeredThing()
+    document.addItems(layer1, layer2, thing)
+    layer1.setItemProperty(thing.id, 'num', 1)
+    layer2.setItemProperty(thing.id, 'num', 2)
+
+    layer1.setActive(True)
+    layer2.setActive(True)
+    assert thing.num() == 2 # last layer wins
+    assert document.layerComposite().get(thing.id, 'num') == (2, True)
+
+    layer2.resetItemProperty(thing.prop('num'))
+    assert document.layerComposite().get(thing.id, 'num') == (1, True) # lower layer fills in
+    thing.prop('num').onActiveLayersChanged()
+    assert thing.num() == 1
+
+    layer1.setActive(False)
+    assert thing.num() == -1
+
+
+def test_layer_overrides_store(qApp):
+    document = Document()
+    layer = Layer(name='Layer 1', active=True)
+    thing1 = LayeredThing()
+    thing2 = LayeredThing()
+    document.addItems(layer, thing1, thing2)
+
+    layer.setItemPropertiesMany([(thing1.id, 'num', 1), (thing2.id, 'num', 2)])
+    assert layer.itemIdsWithProperty('num') == {thing1.id, thing2.id}
+    assert thing1.num() == 1
+    assert thing2.num() == 2
+    assert layer.overrides().data() is layer.itemProperties() # no copy for write()
+
+    layer.resetItemPropertiesMany([(thing2.id, 'num')])
+    assert layer.itemIdsWithProperty('num') == {thing1.id}
+    assert layer.itemProperties() == {thing1.id: {'num': 1}}
+    assert thing2.num() == -1
+
+
+def test_remove_items_captures_only_overrides(qApp, undoStack):
+    document = Document()
+    layer1 = Layer(name='Layer 1', active=True)
+    layer2 = Layer(name='Layer 2')
+    things = [LayeredThing() for i in range(4)]
+    document.addItems(layer1, layer2, *things)
+    layer1.setItemPropertiesMany([(things[0].id, 'num', 1), (things[3].id, 'num', 3)])
+    layer2.setItemPropertiesMany([(things[1].id, 'num', 2)])
+
+    commands.removeItems(document, things[:2])
+    assert layer1.itemProperties() == {things[3].id: {'num': 3}}
+    assert layer2.itemProperties() == {}
+    assert things[0].num() == -1
+
+    undoStack.undo()
+    assert layer1.itemIdsWithProperty('num') == {things[0].id, things[3].id}
+    assert layer2.itemProperties() == {things[1].id: {'num': 2}}
+    assert things[0].num() == 1
+
+    itemsRemoved = util.Condition(document.itemsRemoved)
+    document.removeItems(layer2, *things)
+    assert itemsRemoved.callCount == 1
+    assert len(itemsRemoved.lastCallArgs[0]) == 5
+    assert document.layers() == [layer1]
+    assert layer1.itemProperties() == {} # overrides go with the items
+
+
+def test_set_under_higher_active_layer(qApp):
+    document = Document()
+    layer1 = Layer(name='Layer 1', active=True)
+    layer2 = Layer(name='Layer 2', active=True)
+    thing = LayeredThing()
+    document.addItems(layer1, layer2, thing)
+    layer2.setItemPropertiesMany([(thing.id, 'num', 2)])
+    assert thing.num() == 2
+
+    propertyChanged = util.Condition(document.propertyChanged)
+    assert thing.prop('num').set(1, forLayers=[layer1]) == True
+    assert layer1.getItemProperty(thing.id, 'num') == (1, True)
+    assert thing.num() == 2 # layer2 still wins
+    assert propertyChanged.callCount == 0
+
+    layer2.setActive(False)
+    assert thing.num() == 1
+
+
+class GatedLayer(Layer):
+
+    Item.registerProperties((
+        { 'attr': 'storeNum', 'type': bool, 'default': False },
+    ))
+
+
+class GatedThing(Item):
+
+    Item.registerProperties((
+        { 'attr': 'gated', 'type': int, 'default': -1, 'layered': True, 'layerIgnoreAttr': 'storeNum' },
+    ))
+
+
+def test_composite_skips_ignored_layers(qApp):
+    document = Document()
+    layer1 = GatedLayer(name='Layer 1', storeNum=True)
+    layer2 = GatedLayer(name='Layer 2')
+    thing = GatedThing()
+    document.addItems(layer1, layer2, thing)
+    layer1.setItemProperty(thing.id, 'gated', 1)
+    layer2.setItemProperty(thing.id, 'gated', 2) # bypasses Property.set()'s filter
+    layer1.setActive(True)
+    layer2.setActive(True)
+    assert document.layerComposite().get(thing.id, 'gated') == (1, True)
+    assert thing.gated() == 1
+    assert thing.gated(forLayers=[layer1, layer2]) == 1
+
+    layer2.setItemProperty(thing.id, 'gated', 3) # patched in place
+    assert document.layerComposite().get(thing.id, 'gated') == (1, True)
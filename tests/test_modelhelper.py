@@ -1,5 +1,5 @@
 from qtbridge.pyqt import Qt, QObject
-from qtbridge import Debug, util, objects, ModelHelper
+from qtbridge import Debug, util, objects, commands, ModelHelper
 
 
 class MyItem(objects.Item):
@@ -93,6 +93,38 @@ def test_custom_setter():
     model.setNewEntry(123)
     assert model.newEntry == 123
 
+
+
+def test_set_many_items_one_command():
+    commands.stack().clear()
+    items = [MyItem(myint=i) for i in range(5)]
+    model = Model()
+    model.items = items
+
+    model.myint = 100
+    model.myint = 200
+    assert commands.stack().count() == 2
+    assert [item.myint() for item in items] == [200] * 5
+    command = commands.stack().command(1)
+    assert isinstance(command, commands.SetItemProperties)
+    assert len(command.data) == 5
+
+    commands.stack().undo()
+    assert [item.myint() for item in items] == [100] * 5
+    commands.stack().undo()
+    assert [item.myint() for item in items] == list(range(5))
+
+
+def test_onDocumentProperty_per_item():
+    received = []
+    class DocumentModel(Model):
+        def onDocumentProperty(self, prop):
+            received.append((prop.item, prop.name()))
+    model = DocumentModel()
+    item1, item2 = MyItem(), MyItem()
+    model.onDocumentPropertiesChanged([item1.prop('myint'), item2.prop('myint')])
+    assert received == [(item1, 'myint'), (item2, 'myint')]
+
     
 def test_default():
     